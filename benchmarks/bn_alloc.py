@@ -0,0 +1,76 @@
+# Allocation count of the MAML inner loop per inner step, with the current BatchNorm2d_fw and with the
+# legacy one that built fresh running statistics on every call.
+# Run from the repository root:  python -m benchmarks.bn_alloc --model Conv4 --steps 5 --device cpu
+
+import argparse
+import json
+import torch
+import torch.nn.functional as F
+
+import backbone
+from io_utils import model_dict
+from methods.maml import MAML
+from benchmarks.harness import AllocationCounter, per_step
+
+
+def legacy_bn_forward(self, x): #BatchNorm2d_fw.forward before the running statistics were dropped
+    running_mean = torch.zeros(x.data.size()[1]).to(x.device)
+    running_var = torch.ones(x.data.size()[1]).to(x.device)
+    if self.weight.fast is not None and self.bias.fast is not None:
+        out = F.batch_norm(x, running_mean, running_var, self.weight.fast, self.bias.fast, training = True, momentum = 1)
+    else:
+        out = F.batch_norm(x, running_mean, running_var, self.weight, self.bias, training = True, momentum = 1)
+    return out
+
+
+def count_episode(model, x, task_update_num):
+    model.task_update_num = task_update_num
+    with AllocationCounter() as counter:
+        loss = model.set_forward_loss(x)
+        loss.backward()
+    model.zero_grad()
+    return counter.stats()
+
+
+def run(params):
+    backbone.ConvBlock.maml = True
+    backbone.SimpleBlock.maml = True
+    backbone.BottleneckBlock.maml = True
+    backbone.ResNet.maml = True
+
+    image_size = 84 if 'Conv' in params.model else 224
+    model = MAML(model_dict[params.model], n_way = params.n_way, n_support = params.n_shot).to(params.device)
+    model.n_query = params.n_query
+    x = torch.randn(params.n_way, params.n_shot + params.n_query, 3, image_size, image_size)
+    n_bn = sum( isinstance(m, backbone.BatchNorm2d_fw) for m in model.modules() )
+
+    results = {}
+    current_forward = backbone.BatchNorm2d_fw.forward
+    for name, forward in [('legacy', legacy_bn_forward), ('current', current_forward)]:
+        backbone.BatchNorm2d_fw.forward = forward
+        totals = [ count_episode(model, x, k) for k in range(params.steps + 1) ]
+        results[name] = dict(episode = totals[-1], per_step = per_step(totals))
+    backbone.BatchNorm2d_fw.forward = current_forward
+
+    for name in results:
+        steps = results[name]['per_step']
+        flat = all( s == steps[0] for s in steps )
+        print('%-8s %d BN layers | per inner step: %d tensors, %.1f MB, %d factory, %d transfers | flat across steps: %s' %(
+              name, n_bn, steps[0]['tensors'], steps[0]['bytes'] / 2**20, steps[0]['factory'], steps[0]['transfers'], flat))
+
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(dict(config = vars(params), bn_layers = n_bn, results = results), f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'allocation count of the MAML inner loop per inner step')
+    parser.add_argument('--model'   , default='Conv4', help='model: Conv{4|6} / ResNet{10|18|34|50|101}')
+    parser.add_argument('--n_way'   , default=3, type=int)
+    parser.add_argument('--n_shot'  , default=1, type=int)
+    parser.add_argument('--n_query' , default=16, type=int)
+    parser.add_argument('--steps'   , default=5, type=int, help='largest task_update_num to measure')
+    parser.add_argument('--device'  , default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--out'     , default='', help='optional json file for the raw counts')
+    run(parser.parse_args())
@@ -0,0 +1,97 @@
+# Episodes/sec of SetDataManager loaders on a synthetic JPEG filelist written to a temporary directory:
+# the legacy SetDataset (one nested DataLoader per class) against EpisodeDataset with EpisodicSampler (persistent per-class cursors,
+# one worker builds a whole episode), at every --n_ways, over --epochs epochs so that worker start-up is part of the cost.
+# Run from the repository root:  python -m benchmarks.episode_loader --class_size 1000 --num_workers 2 --persistent_workers
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+
+from data.datamgr import SetDataManager
+from data.dataset import EpisodicBatchSampler, EpisodicSampler
+
+
+def write_filelist(root, n_classes, class_size, disk_size):
+    rng = np.random.RandomState(0)
+    names, labels = [], []
+    for cl in range(n_classes):
+        for i in range(class_size):
+            path = os.path.join(root, '%d_%d.jpg' %(cl, i))
+            Image.fromarray(rng.randint(0, 256, (disk_size, disk_size, 3), dtype = np.uint8)).save(path)
+            names.append(path)
+            labels.append(cl)
+    data_file = os.path.join(root, 'base.json')
+    with open(data_file, 'w') as f:
+        json.dump(dict(label_names = [str(cl) for cl in range(n_classes)], image_names = names, image_labels = labels), f)
+    return data_file
+
+
+def episodes_per_sec(data_file, params, n_way, legacy_sampler):
+    datamgr = SetDataManager(params.image_size, n_way = n_way, n_support = params.n_shot, n_query = params.n_query,
+                             n_eposide = params.n_episodes, device = 'cpu', num_workers = params.num_workers, legacy_sampler = legacy_sampler,
+                             prefetch_factor = params.prefetch_factor, persistent_workers = params.persistent_workers)
+    loader = datamgr.get_data_loader(data_file, aug = 'none')
+    start_time = time.perf_counter()
+    for epoch in range(params.epochs):
+        for x, _ in loader:
+            assert x.size()[:2] == (n_way, params.n_shot + params.n_query)
+    return params.epochs * params.n_episodes / (time.perf_counter() - start_time)
+
+
+def sampling_episodes_per_sec(params, n_way, legacy_sampler):
+    #index sampling alone, no image is read: the per-episode construction cost of both samplers
+    batch_size = params.n_shot + params.n_query
+    labels = np.repeat(range(params.n_classes), params.class_size)
+    start_time = time.perf_counter()
+    if legacy_sampler: #what SetDataset does, one shuffled DataLoader iterator per drawn class
+        sub_dataloader = [ torch.utils.data.DataLoader(range(cl*params.class_size, (cl+1)*params.class_size), batch_size = batch_size, shuffle = True)
+                           for cl in range(params.n_classes) ]
+        for classes in EpisodicBatchSampler(params.n_classes, n_way, params.n_episodes):
+            ids = torch.stack([ next(iter(sub_dataloader[cl])) for cl in classes ])
+    else:
+        for ids in EpisodicSampler(labels, n_way, batch_size, params.n_episodes):
+            pass
+    return params.n_episodes / (time.perf_counter() - start_time)
+
+
+def run(params):
+    results = dict(config = vars(params))
+    with tempfile.TemporaryDirectory() as root:
+        data_file = write_filelist(root, params.n_classes, params.class_size, params.disk_size)
+        for n_way in params.n_ways:
+            res = results['%d-way' %(n_way)] = {}
+            for name, legacy_sampler in [('legacy', True), ('episode', False)]:
+                res[name + '_sampling'] = sampling_episodes_per_sec(params, n_way, legacy_sampler)
+                res[name] = episodes_per_sec(data_file, params, n_way, legacy_sampler)
+                print('%-8s %d-way %d-shot %d-query, %d images per class: %.1f episodes/sec (index sampling only: %.1f)' %(
+                      name, n_way, params.n_shot, params.n_query, params.class_size, res[name], res[name + '_sampling']))
+            print('speedup %.2fx (index sampling only: %.2fx)' %(res['episode'] / res['legacy'], res['episode_sampling'] / res['legacy_sampling']))
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(results, f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    mp.set_start_method('spawn')
+    parser = argparse.ArgumentParser(description = 'episodes/sec of the episodic data loaders')
+    parser.add_argument('--n_classes'   , default=5, type=int)
+    parser.add_argument('--class_size'  , default=1000, type=int, help='images per class')
+    parser.add_argument('--disk_size'   , default=96, type=int, help='side of the synthetic JPEGs')
+    parser.add_argument('--image_size'  , default=84, type=int, help='network input size, 84 for Conv, 224 for ResNet')
+    parser.add_argument('--n_ways'      , default=[3, 5], type=int, nargs='+', help='ways to measure, each needs n_classes >= n_way')
+    parser.add_argument('--n_shot'      , default=1, type=int)
+    parser.add_argument('--n_query'     , default=16, type=int)
+    parser.add_argument('--n_episodes'  , default=100, type=int, help='episodes per epoch')
+    parser.add_argument('--epochs'      , default=2, type=int)
+    parser.add_argument('--num_workers' , default=0, type=int, help='0 measures the per-episode overhead in the main process')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='episodes loaded in advance by each worker')
+    parser.add_argument('--persistent_workers', action='store_true', help='keep the workers alive across epochs')
+    parser.add_argument('--out'         , default='', help='optional json file for the results')
+    run(parser.parse_args())
@@ -0,0 +1,99 @@
+# Accuracy parity and speed of the batched head solvers of BaselineFinetune (test.py --finetune) against the per-episode
+# SGD recipe of set_forward_adaptation, on the same episodes. For every loss type (baseline: softmax, baseline++: dist) and solver:
+#   acc          mean test accuracy ± 1.96*std/sqrt(n)
+#   diff         mean and max |accuracy - SGD accuracy| per episode, in points
+#   agreement    share of query predictions equal to those of the SGD heads
+#   seconds      wall time of all episodes
+# Features are class clusters of --feat_dim non-negative synthetic features, or the features of a save_features.py file (--features).
+# Run from the repository root:  python -m benchmarks.finetune_heads --n_shot 1 5 --iter_num 600
+
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+from data.feature_loader import ClassFeatures, init_loader
+from data.manifest import EpisodeManifest
+from io_utils import model_dict
+from methods.baselinefinetune import BaselineFinetune
+
+
+def synthetic_features(params):
+    rng = np.random.default_rng(0)
+    means = np.maximum(rng.normal(size = (params.n_classes, params.feat_dim)), 0)
+    labels = np.repeat(np.arange(params.n_classes), params.class_size)
+    feats = np.maximum(means[labels] + params.noise* rng.normal(size = (len(labels), params.feat_dim)), 0).astype(np.float32)
+    return ClassFeatures(feats, list(range(params.n_classes)), np.arange(params.n_classes)* params.class_size,
+                         np.full(params.n_classes, params.class_size), filelist_order = True)
+
+
+def evaluate(model, feats, ids, n_query, solver, episode_batch):
+    #query predictions of every episode, [iter_num, n_way* n_query]
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model.n_query = n_query
+    preds = []
+    if solver == 'sgd':
+        for episode_ids in ids:
+            preds.append(model.set_forward_adaptation(torch.from_numpy(feats[episode_ids])).argmax(1).numpy()[None])
+    else:
+        model.solver = solver
+        with torch.no_grad():
+            for i in range(0, len(ids), episode_batch):
+                preds.append(model.set_forward_batch(torch.from_numpy(feats[ids[i: i+episode_batch]])).argmax(2).numpy())
+    return np.concatenate(preds)
+
+
+def run(params):
+    cl_data_file = init_loader(params.features) if params.features else synthetic_features(params)
+    feats = np.asarray(cl_data_file.feats, dtype = np.float32)
+    labels = np.repeat(cl_data_file.class_list, cl_data_file.sizes)
+    results = []
+    for n_shot in params.n_shot:
+        manifest = EpisodeManifest.generate(labels, params.n_way, n_shot + params.n_query, params.iter_num)
+        ids = manifest.feature_ids(cl_data_file)
+        y = np.repeat(range(params.n_way), params.n_query)
+        for loss_type in params.loss_types:
+            model = BaselineFinetune(model_dict['Conv4'], n_way = params.n_way, n_support = n_shot, loss_type = loss_type, ridge_lambda = params.ridge_lambda)
+            model.feat_dim = feats.shape[1] #heads only, the backbone is never run
+            reference = None
+            for solver in ['sgd'] + params.solvers:
+                start_time = time.perf_counter()
+                pred = evaluate(model, feats, ids, params.n_query, solver, params.episode_batch)
+                seconds = time.perf_counter() - start_time
+                acc = np.mean(pred == y, axis = 1)*100
+                if reference is None:
+                    reference = pred
+                ref_acc = np.mean(reference == y, axis = 1)*100
+                res = dict(n_shot = n_shot, loss_type = loss_type, solver = solver, seconds = seconds,
+                           acc = float(acc.mean()), ci = float(1.96* acc.std()/np.sqrt(len(acc))),
+                           mean_diff = float(np.abs(acc - ref_acc).mean()), max_diff = float(np.abs(acc - ref_acc).max()),
+                           agreement = float(np.mean(pred == reference)*100))
+                results.append(res)
+                print('%dshot | %-7s | %-10s | acc %5.2f%% ± %4.2f%% | diff mean %5.2f max %6.2f | agreement %6.2f%% | %7.2f s' %(
+                      n_shot, loss_type, solver, res['acc'], res['ci'], res['mean_diff'], res['max_diff'], res['agreement'], seconds))
+
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(dict(config = vars(params), results = results), f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'accuracy parity and speed of the batched BaselineFinetune head solvers')
+    parser.add_argument('--features'    , default='', help='hdf5 written by save_features.py, synthetic features if empty')
+    parser.add_argument('--n_way'       , default=3, type=int)
+    parser.add_argument('--n_shot'      , default=[1, 5], nargs='+', type=int)
+    parser.add_argument('--n_query'     , default=15, type=int)
+    parser.add_argument('--iter_num'    , default=600, type=int)
+    parser.add_argument('--loss_types'  , default=['softmax', 'dist'], nargs='+', help='softmax (baseline), dist (baseline++)')
+    parser.add_argument('--solvers'     , default=['full_batch', 'lbfgs', 'ridge'], nargs='+')
+    parser.add_argument('--ridge_lambda', default=0.1, type=float)
+    parser.add_argument('--episode_batch', default=100, type=int)
+    parser.add_argument('--n_classes'   , default=5, type=int, help='synthetic features only')
+    parser.add_argument('--class_size'  , default=200, type=int, help='synthetic features only')
+    parser.add_argument('--feat_dim'    , default=512, type=int, help='synthetic features only')
+    parser.add_argument('--noise'       , default=3.0, type=float, help='synthetic features only: within-class standard deviation')
+    parser.add_argument('--out'         , default='', help='optional json file for the results')
+    run(parser.parse_args())
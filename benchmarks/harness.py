@@ -0,0 +1,6 @@
+from profiling import AllocationCounter, FACTORY_OPS #re-exported, the counter is also used by the training profiler
+
+
+def per_step(totals):
+    #totals[k] are the counts of a run with k inner steps, returns the increment of every step
+    return [ { key: totals[k][key] - totals[k-1][key] for key in totals[k] } for k in range(1, len(totals)) ]
@@ -0,0 +1,193 @@
+# Meta-training throughput of every method wired in train.py on synthetic episodes, no dataset on disk needed:
+# episodes/sec, peak RSS and the time per episode of each phase of a training step
+#   data            synthetic episode moved to the device
+#   inner_loop      set_forward_loss, the fast weight adaptation and query forward for maml variants, the plain forward otherwise
+#   outer_backward  loss.backward(), once per meta-batch of n_task episodes for maml variants
+#   optimizer       optimizer.step() and zero_grad()
+# Every (method, model) pair runs in a fresh process so peak RSS is its own. Results go to --out as json, pass an earlier
+# file to --compare to print the episodes/sec ratio per pair.
+# Run from the repository root:  python -m benchmarks.meta_train --models Conv4 --device cpu --out conv4.json
+
+import argparse
+import json
+import resource
+import subprocess
+import time
+import torch
+import torch.multiprocessing as mp
+
+import backbone
+from io_utils import model_dict
+from methods.baselinetrain import BaselineTrain
+from methods.protonet import ProtoNet
+from methods.matchingnet import MatchingNet
+from methods.relationnet import RelationNet
+from methods.maml import MAML
+from methods.tra_maml import TRA_MAML
+
+METHODS = ['baseline', 'baseline++', 'protonet', 'matchingnet', 'relationnet', 'relationnet_softmax', 'maml', 'maml_approx', 'tra_maml']
+PHASES = ['data', 'inner_loop', 'outer_backward', 'optimizer']
+
+
+def build_model(method, model_name, n_way, n_shot, num_classes = 7, tra = '1-5-0.4', batch_tasks = False):
+    #the model train.py builds for method
+    maml = method in ['maml', 'maml_approx', 'tra_maml']
+    backbone.ConvBlock.maml = maml
+    backbone.SimpleBlock.maml = maml
+    backbone.BottleneckBlock.maml = maml
+    backbone.ResNet.maml = maml
+
+    few_shot_params = dict(n_way = n_way, n_support = n_shot)
+    if method == 'baseline':
+        return BaselineTrain( model_dict[model_name], num_classes)
+    elif method == 'baseline++':
+        return BaselineTrain( model_dict[model_name], num_classes, loss_type = 'dist')
+    elif method == 'protonet':
+        return ProtoNet( model_dict[model_name], **few_shot_params )
+    elif method == 'matchingnet':
+        return MatchingNet( model_dict[model_name], **few_shot_params )
+    elif method in ['relationnet', 'relationnet_softmax']:
+        if model_name == 'Conv4':
+            feature_model = backbone.Conv4NP
+        elif model_name == 'Conv6':
+            feature_model = backbone.Conv6NP
+        else:
+            feature_model = lambda: model_dict[model_name]( flatten = False )
+        loss_type = 'mse' if method == 'relationnet' else 'softmax'
+        return RelationNet( feature_model, loss_type = loss_type, **few_shot_params )
+    elif method in ['maml', 'maml_approx']:
+        return MAML( model_dict[model_name], approx = (method == 'maml_approx'), batch_tasks = batch_tasks, **few_shot_params )
+    elif method == 'tra_maml':
+        min_step, max_step, width = tra.split('-')
+        return TRA_MAML( model_dict[model_name], min_step = int(min_step), max_step = int(max_step), width = float(width),
+                         test_mode = False, approx = False, batch_tasks = batch_tasks, **few_shot_params )
+    raise ValueError('Unknown method')
+
+
+def sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def bench_one(method, model_name, params):
+    rss_baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    torch.manual_seed(0)
+    image_size = 84 if 'Conv' in model_name else 224
+    model = build_model(method, model_name, params.n_way, params.n_shot, tra = params.tra, batch_tasks = params.batch_tasks).to(params.device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr = 0.0001)
+
+    if method in ['baseline', 'baseline++']: #an "episode" is one batch of the SimpleDataManager loader
+        pool = [ (torch.randn(params.baseline_batch, 3, image_size, image_size), torch.randint(0, model.num_class, (params.baseline_batch,))) for _ in range(2) ]
+        n_task = 1
+    else:
+        pool = [ (torch.randn(params.n_way, params.n_shot + params.n_query, 3, image_size, image_size), None) for _ in range(2) ]
+        model.n_query = params.n_query
+        n_task = getattr(model, 'n_task', 1)
+        if method == 'tra_maml':
+            model.set_epoch(params.tra_epoch)
+
+    n_meta_batch = -(-params.n_episodes // n_task)
+    times = dict.fromkeys(PHASES, 0.)
+    for b in range(params.warmup + n_meta_batch):
+        if b == params.warmup: #warm-up meta-batches are not timed
+            times = dict.fromkeys(PHASES, 0.)
+            start_time = time.perf_counter()
+        losses = []
+        x_all = []
+        for t in range(n_task):
+            t0 = time.perf_counter()
+            x, y = pool[(b* n_task + t) % len(pool)]
+            x = x.to(params.device)
+            if y is not None:
+                y = y.to(params.device)
+            sync(params.device)
+            t1 = time.perf_counter()
+            if y is not None:
+                losses.append(model.forward_loss(x, y))
+            elif method in ['maml', 'maml_approx', 'tra_maml'] and params.batch_tasks:
+                x_all.append(x)
+            else:
+                losses.append(model.set_forward_loss(x))
+            sync(params.device)
+            t2 = time.perf_counter()
+            times['data'] += t1 - t0
+            times['inner_loop'] += t2 - t1
+
+        t2 = time.perf_counter()
+        if x_all:
+            loss = model.set_forward_loss_batch(torch.stack(x_all))
+        else:
+            loss = torch.stack(losses).sum(0)
+        sync(params.device)
+        t3 = time.perf_counter()
+        loss.backward()
+        sync(params.device)
+        t4 = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad()
+        sync(params.device)
+        t5 = time.perf_counter()
+        times['inner_loop'] += t3 - t2 #the batched adaptation runs once per meta-batch
+        times['outer_backward'] += t4 - t3
+        times['optimizer'] += t5 - t4
+
+    total = time.perf_counter() - start_time
+    n_episodes = n_meta_batch* n_task
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(method = method, model = model_name,
+                episodes_per_sec = n_episodes / total,
+                peak_rss_mb = peak_rss / 1024, #ru_maxrss is in KB on Linux
+                model_rss_mb = (peak_rss - rss_baseline) / 1024, #above the process after imports
+                phases = { phase: times[phase] / n_episodes for phase in PHASES }) #seconds per episode
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL, text = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(params):
+    results = dict(config = vars(params), commit = git_commit(), results = [])
+    ctx = mp.get_context('spawn')
+    for model_name in params.models:
+        for method in params.methods:
+            with ctx.Pool(1) as pool: #fresh process, so ru_maxrss is the peak of this pair only
+                res = pool.apply(bench_one, (method, model_name, params))
+            results['results'].append(res)
+            print('%-20s %-9s %7.2f episodes/sec | peak RSS %6.0f MB (+%5.0f) | per episode: %s' %(
+                  method, model_name, res['episodes_per_sec'], res['peak_rss_mb'], res['model_rss_mb'],
+                  ', '.join( '%s %.1f ms' %(phase, 1000* res['phases'][phase]) for phase in PHASES )))
+
+    if params.compare:
+        with open(params.compare, 'r') as f:
+            before = { (r['method'], r['model']): r for r in json.load(f)['results'] }
+        for res in results['results']:
+            old = before.get((res['method'], res['model']))
+            if old is not None:
+                print('%-20s %-9s %.2fx episodes/sec vs %s' %(res['method'], res['model'], res['episodes_per_sec'] / old['episodes_per_sec'], params.compare))
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(results, f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'meta-training throughput of every method on synthetic episodes')
+    parser.add_argument('--methods'     , default=['baseline', 'baseline++', 'protonet', 'matchingnet', 'relationnet', 'maml', 'maml_approx', 'tra_maml'], nargs='+', choices=METHODS)
+    parser.add_argument('--models'      , default=['Conv4', 'ResNet10'], nargs='+', help='Conv{4|6} / ResNet{10|18|34}')
+    parser.add_argument('--n_way'       , default=3, type=int)
+    parser.add_argument('--n_shot'      , default=1, type=int)
+    parser.add_argument('--n_query'     , default=16, type=int)
+    parser.add_argument('--baseline_batch', default=16, type=int, help='images per batch for baseline/baseline++, counted as one episode')
+    parser.add_argument('--n_episodes'  , default=8, type=int, help='timed episodes, rounded up to whole meta-batches')
+    parser.add_argument('--warmup'      , default=1, type=int, help='untimed meta-batches first')
+    parser.add_argument('--tra'         , default='1-5-0.4', help='TRA configuration for tra_maml: min_step-max_step-width')
+    parser.add_argument('--tra_epoch'   , default=100, type=int, help='epoch whose TRA inner step count tra_maml runs')
+    parser.add_argument('--batch_tasks' , action='store_true', help='maml variants adapt the tasks of a meta-batch at once')
+    parser.add_argument('--device'      , default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--compare'     , default='', help='earlier json output to compare episodes/sec with')
+    parser.add_argument('--out'         , default='', help='json file for the results')
+    run(parser.parse_args())
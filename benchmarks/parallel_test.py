@@ -0,0 +1,89 @@
+# Wall time of test.py --test_workers N on synthetic images, no dataset on disk needed: the episodes of one episode
+# manifest evaluated by parallel_eval.parallel_test on a pool of N processes of --threads_per_worker torch threads, for
+# every N of --workers. For each N:
+#   seconds    wall time of all episodes, pool start-up included
+#   speedup    against 1 worker, near N while N* threads_per_worker is within the free cores
+#   same       the per-run mean accuracy equals the 1 worker one
+# Run from the repository root:  python -m benchmarks.parallel_test --workers 1 2 4 --iter_num 100 --method maml
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+
+import backbone
+from data.manifest import EpisodeManifest
+from io_utils import model_dict
+from methods.maml import MAML
+from methods.tra_maml import TRA_MAML
+from parallel_eval import parallel_test
+
+
+class SyntheticImages:
+    #flat dataset of random images, class c has mean c/n_classes, indexed like SimpleDataset
+    def __init__(self, n_classes, class_size, image_size):
+        generator = torch.Generator().manual_seed(0)
+        self.labels = np.repeat(np.arange(n_classes), class_size)
+        self.images = torch.randn(len(self.labels), 3, image_size, image_size, generator = generator) + torch.from_numpy(self.labels)[:, None, None, None].float()/ n_classes
+
+    def __getitem__(self, i):
+        return self.images[i], int(self.labels[i])
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def run(params):
+    backbone.ConvBlock.maml = True
+    backbone.SimpleBlock.maml = True
+    backbone.BottleneckBlock.maml = True
+    backbone.ResNet.maml = True
+    torch.manual_seed(0)
+    if params.method == 'tra_maml':
+        model = TRA_MAML(model_dict[params.model], n_way = params.n_way, n_support = params.n_shot, min_step = 1, max_step = params.steps, width = 0.4, test_mode = True)
+    else:
+        model = MAML(model_dict[params.model], n_way = params.n_way, n_support = params.n_shot, approx = params.method == 'maml_approx')
+        model.task_update_num = params.steps
+
+    image_size = 84 if 'Conv' in params.model else 224
+    dataset = SyntheticImages(params.n_classes, params.class_size, image_size)
+    manifest = EpisodeManifest.generate(dataset.labels, params.n_way, params.n_shot + params.n_query, params.iter_num)
+    episode_ids = manifest.image_ids(dataset.labels)
+
+    results = []
+    for workers in params.workers:
+        start_time = time.perf_counter()
+        acc_mean, acc_std, avg_loss = parallel_test(model, dataset, episode_ids, workers, threads = params.threads_per_worker)
+        seconds = time.perf_counter() - start_time
+        results.append(dict(workers = workers, seconds = seconds, acc = float(acc_mean), loss = avg_loss))
+
+    base = results[0]
+    for res in results:
+        res['speedup'] = base['seconds'] / res['seconds']
+        res['same'] = res['acc'] == base['acc'] and res['loss'] == base['loss']
+        print('%2d workers x %d threads | %7.2f s | speedup %5.2f | same accuracy as %d worker(s): %s' %(
+              res['workers'], params.threads_per_worker, res['seconds'], res['speedup'], base['workers'], res['same']))
+
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(dict(config = vars(params), cores = len(os.sched_getaffinity(0)), results = results), f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'wall time of test.py --test_workers N on synthetic episodes')
+    parser.add_argument('--workers'     , default=[1, 2, 4], nargs='+', type=int, help='pool sizes, the first one is the speedup baseline')
+    parser.add_argument('--threads_per_worker', default=1, type=int)
+    parser.add_argument('--method'      , default='maml', help='maml / maml_approx / tra_maml')
+    parser.add_argument('--model'       , default='Conv4')
+    parser.add_argument('--steps'       , default=5, type=int, help='inner steps of every test episode')
+    parser.add_argument('--n_way'       , default=3, type=int)
+    parser.add_argument('--n_shot'      , default=5, type=int)
+    parser.add_argument('--n_query'     , default=15, type=int)
+    parser.add_argument('--iter_num'    , default=100, type=int)
+    parser.add_argument('--n_classes'   , default=5, type=int)
+    parser.add_argument('--class_size'  , default=40, type=int)
+    parser.add_argument('--out'         , default='', help='optional json file for the results')
+    run(parser.parse_args())
@@ -0,0 +1,111 @@
+# Relation module of RelationNet on one episode of synthetic backbone feature maps: the previous pair construction
+# (n_way* n_query concatenated [proto, query] copies through the first conv) against RelationModule.forward_pairs
+# (first conv split into its proto and query halves, run once per prototype and once per query, added by broadcasting).
+# For every backbone and way, forward and backward of both:
+#   rel_diff     largest difference of the relations and of the parameter gradients, relative to their largest magnitude
+#   alloc        bytes allocated by the forward and backward (CUDA: peak of the caching allocator)
+#   conv1 flops  multiply-adds of the first relation conv
+#   seconds      mean wall time over --repeat runs
+# Run from the repository root:  python -m benchmarks.relation_pairs --models Conv4 ResNet10 --n_ways 3 5 10 20 --device cpu
+
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+import backbone
+from methods.relationnet import RelationModule
+from profiling import AllocationCounter
+
+feature_models = dict(Conv4 = backbone.Conv4NP, Conv6 = backbone.Conv6NP, ResNet10 = lambda: backbone.ResNet10(flatten = False),
+                      ResNet18 = lambda: backbone.ResNet18(flatten = False), ResNet34 = lambda: backbone.ResNet34(flatten = False))
+
+
+def concat_pairs(module, z_proto, z_query):
+    #relations as RelationNet.set_forward built them before forward_pairs
+    n_way, n_query = z_proto.size(0), z_query.size(0)
+    z_proto_ext = z_proto.unsqueeze(0).repeat(n_query,1,1,1,1)
+    z_query_ext = torch.transpose(z_query.unsqueeze(0).repeat(n_way,1,1,1,1),0,1)
+    relation_pairs = torch.cat((z_proto_ext,z_query_ext),2).view(n_query* n_way, -1, *z_proto.size()[2:])
+    return module(relation_pairs).view(-1, n_way)
+
+
+def forward_pairs(module, z_proto, z_query):
+    return module.forward_pairs(z_proto, z_query)
+
+
+def conv1_flops(module, feat_dim, n_way, n_query, split):
+    conv = module.layer1.C
+    out_size = np.prod(conv(torch.zeros(1, *conv.weight.size()[1:2], *feat_dim[1:], device = conv.weight.device)).size()[2:])
+    per_map = conv.weight.numel() * out_size #multiply-adds of one full [2* dim] input
+    if split:
+        return int(per_map/2 * (n_way + n_query) + n_way* n_query* conv.out_channels* out_size) #halves, then the broadcast add
+    return int(per_map * n_way* n_query)
+
+
+def measure(fn, module, z_proto, z_query, params):
+    cuda = torch.device(params.device).type == 'cuda'
+    times = []
+    for r in range(params.repeat + 1): #the first run is a warm-up
+        module.zero_grad()
+        if cuda:
+            torch.cuda.synchronize(params.device)
+            torch.cuda.reset_peak_memory_stats(params.device)
+            memory_before = torch.cuda.memory_allocated(params.device)
+        start_time = time.perf_counter()
+        if r == 0 and not cuda:
+            with AllocationCounter() as counter:
+                relations = fn(module, z_proto, z_query)
+                relations.sum().backward()
+            alloc = counter.bytes
+        else:
+            relations = fn(module, z_proto, z_query)
+            relations.sum().backward()
+        if cuda:
+            torch.cuda.synchronize(params.device)
+            if r == 0:
+                alloc = torch.cuda.max_memory_allocated(params.device) - memory_before
+        if r > 0:
+            times.append(time.perf_counter() - start_time)
+    grads = torch.cat([ p.grad.reshape(-1) for p in module.parameters() ])
+    return relations.detach(), grads, alloc, float(np.mean(times))
+
+
+def run(params):
+    results = []
+    for model in params.models:
+        feat_dim = feature_models[model]().final_feat_dim
+        torch.manual_seed(0)
+        module = RelationModule(feat_dim, 8, 'mse').to(params.device)
+        for n_way in params.n_ways:
+            z_proto = torch.relu(torch.randn(n_way, *feat_dim, device = params.device))
+            z_query = torch.relu(torch.randn(n_way* params.n_query, *feat_dim, device = params.device))
+            ref, ref_grads, ref_alloc, ref_seconds = measure(concat_pairs, module, z_proto, z_query, params)
+            out, grads, alloc, seconds = measure(forward_pairs, module, z_proto, z_query, params)
+            res = dict(model = model, n_way = n_way, n_query = params.n_query,
+                       rel_diff = float(max((out - ref).abs().max()/ ref.abs().max(), (grads - ref_grads).abs().max()/ ref_grads.abs().max())),
+                       concat_alloc_mb = ref_alloc/2**20, split_alloc_mb = alloc/2**20,
+                       concat_conv1_gflops = conv1_flops(module, feat_dim, n_way, n_way* params.n_query, False)/1e9,
+                       split_conv1_gflops = conv1_flops(module, feat_dim, n_way, n_way* params.n_query, True)/1e9,
+                       concat_seconds = ref_seconds, split_seconds = seconds)
+            results.append(res)
+            print('%-8s %3d-way | rel diff %.1e | alloc %8.1f -> %8.1f MB | conv1 %8.3f -> %7.3f GFLOP | %7.3f -> %7.3f s' %(
+                  model, n_way, res['rel_diff'], res['concat_alloc_mb'], res['split_alloc_mb'],
+                  res['concat_conv1_gflops'], res['split_conv1_gflops'], ref_seconds, seconds))
+
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(dict(config = vars(params), results = results), f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'relation module pair construction: concatenated copies against the split first conv')
+    parser.add_argument('--models'  , default=['Conv4', 'ResNet10'], nargs='+', help='Conv{4|6} / ResNet{10|18|34}')
+    parser.add_argument('--n_ways'  , default=[3, 5, 10, 20], nargs='+', type=int)
+    parser.add_argument('--n_query' , default=15, type=int)
+    parser.add_argument('--repeat'  , default=3, type=int)
+    parser.add_argument('--device'  , default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--out'     , default='', help='optional json file for the results')
+    run(parser.parse_args())
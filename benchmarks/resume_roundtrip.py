@@ -0,0 +1,87 @@
+# Round trip of the --resume state of train.py through a checkpoint written by CheckpointManager: a small model and Adam
+# take a few steps on episodes of an EpisodicSampler, the state is saved, and the run goes on for --steps more episodes.
+# The checkpoint is then loaded with map_location 'cpu' (as train.py does) and with map_location --device (the tensors of
+# the RNG and sampler states on the device, as a GPU run loaded them before), restored into a fresh model, optimizer and
+# sampler the way train() restores them, and the same steps are run again. For every map_location:
+#   episodes     the resumed sampler yields the same episodes
+#   rng          the python, numpy and torch draws after each step are the same
+#   max_diff     largest difference of the weights after the last step, 0 when the resume is exact
+# Run from the repository root:  python -m benchmarks.resume_roundtrip --device cuda:0
+
+import argparse
+import os
+import random
+import tempfile
+import numpy as np
+import torch
+
+from checkpointing import CheckpointManager, set_rng_state
+from data.dataset import EpisodicSampler
+
+
+def build(params, seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    labels = np.repeat(np.arange(params.n_classes), params.class_size)
+    sampler = EpisodicSampler(labels, params.n_way, params.n_per_class, params.steps)
+    model = torch.nn.Linear(params.feat_dim, params.n_way).to(params.device)
+    optimizer = torch.optim.Adam(model.parameters(), lr = 0.01)
+    return sampler, model, optimizer
+
+
+def run_steps(sampler, model, optimizer, params):
+    #one optimizer step per episode, on random features of its images; returns the episodes and the RNG draws
+    episodes, draws = [], []
+    for ids in sampler:
+        x = torch.randn(len(ids), params.feat_dim).to(params.device) + torch.tensor(ids, dtype = torch.float32, device = params.device)[:, None]/ len(ids)
+        y = torch.arange(params.n_way, device = params.device).repeat_interleave(params.n_per_class)
+        loss = torch.nn.functional.cross_entropy(model(x), y)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        episodes.append(ids)
+        draws.append((random.random(), float(np.random.rand()), torch.rand(1).item()))
+    return episodes, draws
+
+
+def run(params):
+    random.seed(0)
+    sampler, model, optimizer = build(params, 0)
+    run_steps(sampler, model, optimizer, params)
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoints = CheckpointManager(checkpoint_dir)
+        checkpoints.save(0, model, optimizer, periodic = True, train_state = dict(samplers = [sampler.state_dict()]))
+        checkpoints.close()
+        ref_episodes, ref_draws = run_steps(sampler, model, optimizer, params)
+        ref_weights = torch.cat([ p.detach().reshape(-1) for p in model.parameters() ])
+
+        exact = True
+        for map_location in ['cpu', params.device]:
+            sampler, model, optimizer = build(params, 1) #other weights, permutations and RNG states, all replaced by the checkpoint
+            random.seed(1)
+            tmp = torch.load(os.path.join(checkpoint_dir, '0.tar'), map_location = map_location)
+            model.load_state_dict(tmp['state'])
+            optimizer.load_state_dict(tmp['optimizer'])
+            set_rng_state(tmp['rng'])
+            sampler.load_state_dict(tmp['train_state']['samplers'][0])
+            episodes, draws = run_steps(sampler, model, optimizer, params)
+            weights = torch.cat([ p.detach().reshape(-1) for p in model.parameters() ])
+            max_diff = (weights - ref_weights).abs().max().item()
+            same = episodes == ref_episodes and draws == ref_draws and max_diff == 0
+            exact = exact and same
+            print('map_location %-8s | episodes %-5s | rng %-5s | max_diff %.1e | %s' %(
+                  map_location, episodes == ref_episodes, draws == ref_draws, max_diff, 'exact' if same else 'MISMATCH'))
+    if not exact:
+        raise SystemExit('the resumed run differs from the uninterrupted one')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'round trip of the --resume state through a device mapped checkpoint')
+    parser.add_argument('--device'      , default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps'       , default=5, type=int, help='episodes before and after the checkpoint')
+    parser.add_argument('--n_way'       , default=5, type=int)
+    parser.add_argument('--n_per_class' , default=6, type=int)
+    parser.add_argument('--n_classes'   , default=10, type=int)
+    parser.add_argument('--class_size'  , default=20, type=int)
+    parser.add_argument('--feat_dim'    , default=32, type=int)
+    run(parser.parse_args())
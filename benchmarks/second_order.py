@@ -0,0 +1,92 @@
+# Memory against meta-gradient accuracy of truncated second order MAML (--second_order_steps in train.py) on
+# synthetic episodes. For every inner step count and every K, one episode's meta-gradient is computed with second
+# order terms through the last K inner steps only, and compared with the full second order meta-gradient:
+#   peak memory   CUDA: max_memory_allocated, CPU: peak RSS above the process before the episode
+#   cosine        cosine similarity with the full second order meta-gradient, 1 is exact
+#   rel_error     |g - g_full| / |g_full|
+# K 0 is first order MAML (maml_approx). Every (steps, K) runs in a fresh process so peak RSS is its own.
+# Run from the repository root:  python -m benchmarks.second_order --model Conv4 --steps 5 10 --device cpu
+
+import argparse
+import json
+import resource
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import backbone
+from io_utils import model_dict
+from methods.maml import MAML
+
+
+def meta_gradient(task_update_num, second_order_steps, params):
+    backbone.ConvBlock.maml = True
+    backbone.SimpleBlock.maml = True
+    backbone.BottleneckBlock.maml = True
+    backbone.ResNet.maml = True
+
+    torch.manual_seed(0)
+    image_size = 84 if 'Conv' in params.model else 224
+    model = MAML(model_dict[params.model], n_way = params.n_way, n_support = params.n_shot, second_order_steps = second_order_steps).to(params.device)
+    model.train()
+    model.n_query = params.n_query
+    model.task_update_num = task_update_num
+    x = torch.randn(params.n_way, params.n_shot + params.n_query, 3, image_size, image_size)
+    with torch.no_grad(): #warm-up, so the one-off allocations of the first forward are not counted
+        model.forward(x.view(-1, *x.size()[2:]).to(params.device))
+
+    cuda = torch.device(params.device).type == 'cuda'
+    if cuda:
+        torch.cuda.synchronize(params.device)
+        torch.cuda.reset_peak_memory_stats(params.device)
+        memory_before = torch.cuda.memory_allocated(params.device)
+    else:
+        memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #ru_maxrss is in KB on Linux
+    start_time = time.perf_counter()
+    loss = model.set_forward_loss(x)
+    loss.backward()
+    if cuda:
+        torch.cuda.synchronize(params.device)
+        peak = torch.cuda.max_memory_allocated(params.device) - memory_before
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - memory_before
+    seconds = time.perf_counter() - start_time
+
+    grad = torch.cat([ weight.grad.reshape(-1) for weight in model.parameters() ]).cpu().numpy()
+    return dict(peak_mb = peak / 2**20, seconds = seconds), grad
+
+
+def run(params):
+    ctx = mp.get_context('spawn')
+    results = []
+    for steps in params.steps:
+        grads = {}
+        for k in [None] + [ k for k in params.second_order_steps if k < steps ]: #K >= steps is full second order
+            with ctx.Pool(1) as pool: #fresh process, so ru_maxrss is the peak of this episode only
+                res, grads[k] = pool.apply(meta_gradient, (steps, k, params))
+            full = grads[None]
+            res.update(steps = steps, second_order_steps = k,
+                       cosine = float(np.dot(grads[k], full) / (np.linalg.norm(grads[k])* np.linalg.norm(full))),
+                       rel_error = float(np.linalg.norm(grads[k] - full) / np.linalg.norm(full)))
+            results.append(res)
+            print('steps %3d | second order through %-4s | peak %8.1f MB | %6.2f s | cosine %.4f | rel error %.4f' %(
+                  steps, 'all' if k is None else k, res['peak_mb'], res['seconds'], res['cosine'], res['rel_error']))
+
+    if params.out:
+        with open(params.out, 'w') as f:
+            json.dump(dict(config = vars(params), results = results), f, indent = 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'memory against meta-gradient accuracy of truncated second order MAML')
+    parser.add_argument('--model'   , default='Conv4', help='model: Conv{4|6} / ResNet{10|18|34|50|101}')
+    parser.add_argument('--n_way'   , default=3, type=int)
+    parser.add_argument('--n_shot'  , default=1, type=int)
+    parser.add_argument('--n_query' , default=16, type=int)
+    parser.add_argument('--steps'   , default=[5, 10], nargs='+', type=int, help='inner step counts (task_update_num) to measure')
+    parser.add_argument('--second_order_steps', default=[0, 1, 2], nargs='+', type=int, help='K values to compare with full second order')
+    parser.add_argument('--device'  , default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--out'     , default='', help='optional json file for the results')
+    run(parser.parse_args())
@@ -0,0 +1,114 @@
+import os
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    #copy of a (nested) state dict with every tensor copied to host, so training can go on updating the originals.
+    #The copies from GPU are started here, CheckpointManager waits for them on its writer thread
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', non_blocking = True, copy = True)
+    if isinstance(obj, dict):
+        out = type(obj)( (k, to_cpu(v)) for k, v in obj.items() )
+        if hasattr(obj, '_metadata'): #module versions, load_state_dict reads them
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)( to_cpu(v) for v in obj )
+    return obj
+
+
+def rng_state():
+    #tensors, tuples and numbers only, so checkpoints still load with torch.load(weights_only = True)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    numpy_state = (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian)
+    state = dict(python = random.getstate(), numpy = numpy_state, torch = torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'].cpu()) #checkpoints loaded with a map_location have their RNG states on the device
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([ s.cpu() for s in state['cuda'] ])
+
+
+class CheckpointManager:
+    #writes the checkpoints of train.py from a background thread: save() snapshots the model (and optimizer) state to
+    #host memory and returns, the writer thread saves it to a temporary file and renames it over the checkpoint, so a
+    #crash mid-write never leaves a truncated best_model.tar or <epoch>.tar behind. Keeps the keep_last latest
+    #<epoch>.tar files (all of them when keep_last is 0) and best_model.tar. Checkpoints hold
+    #  epoch, state       as before, read by test.py, save_features.py and --resume
+    #  optimizer, rng     optimizer.state_dict() and the python/numpy/torch(/cuda) RNG states, for an exact --resume
+    #  any extra keyword given to save()
+    def __init__(self, checkpoint_dir, keep_last = 0, max_pending = 1):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.pending = queue.Queue(max_pending) #bounds the snapshots held in memory when writing is slower than training
+        self.error = None
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def save(self, epoch, model, optimizer = None, best = False, periodic = False, **extra):
+        #best: write best_model.tar, periodic: write <epoch>.tar
+        if self.error is not None:
+            raise self.error
+        names = (['best_model.tar'] if best else []) + (['{:d}.tar'.format(epoch)] if periodic else [])
+        if not names:
+            return
+        state = dict(epoch = epoch, state = to_cpu(model.state_dict()), rng = rng_state(), **extra)
+        if optimizer is not None:
+            state['optimizer'] = to_cpu(optimizer.state_dict())
+        done = None
+        device = next(model.parameters()).device
+        if device.type == 'cuda': #the copies were queued on the stream of the model's device, not necessarily the current device
+            done = torch.cuda.Event()
+            done.record(torch.cuda.current_stream(device))
+        self.pending.put((state, names, done))
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            state, names, done = item
+            try:
+                if done is not None:
+                    done.synchronize()
+                for name in names:
+                    self.write(state, os.path.join(self.checkpoint_dir, name))
+                self.prune()
+            except Exception as e:
+                self.error = e
+
+    def write(self, state, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path) #atomic, readers see the old or the new checkpoint
+
+    def prune(self):
+        if self.keep_last <= 0:
+            return
+        epochs = sorted( int(name[:-len('.tar')]) for name in os.listdir(self.checkpoint_dir) if re.fullmatch(r'\d+\.tar', name) )
+        for epoch in epochs[:-self.keep_last]:
+            os.remove(os.path.join(self.checkpoint_dir, '{:d}.tar'.format(epoch)))
+
+    def close(self):
+        #waits for the pending checkpoints, raises the error of a failed write
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -2,3 +2,4 @@ from . import datamgr
 from . import dataset
 from . import additional_transforms
 from . import feature_loader
+from . import image_cache
@@ -5,8 +5,9 @@ from PIL import Image
 import numpy as np
 import torchvision.transforms as transforms
 import data.additional_transforms as add_transforms
-from data.dataset import SimpleDataset, SetDataset, EpisodicBatchSampler
+from data.dataset import SimpleDataset, SetDataset, PackedSimpleDataset, PackedSetDataset, EpisodicBatchSampler, EpisodicSampler, EpisodeDataset, packed_file
 from abc import abstractmethod
+import itertools
 import os
         
 
@@ -14,6 +15,7 @@ import os
 class TransformLoader:
     def __init__(self, image_size, normalize_param=None, jitter_param=None):
         self.image_size = image_size
+        self.resize_size = int(image_size*1.15) #size of the 'none' Resize, and of the images packed by pack_images.py
         self.normalize_param = normalize_param or dict(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         self.jitter_param = jitter_param or dict(Brightness=0.4, Contrast=0.4, Color=0.4)
 
@@ -30,7 +32,7 @@ class TransformLoader:
         elif transform_type=='CenterCrop':
             return method(self.image_size) 
         elif transform_type=='Resize':
-            return method([int(self.image_size*1.15), int(self.image_size*1.15)])
+            return method([self.resize_size, self.resize_size])
         elif transform_type=='Normalize':
             return method(**self.normalize_param )
 
@@ -59,43 +61,98 @@ class DataManager:
 
 
 class SimpleDataManager(DataManager):
-    def __init__(self, image_size, batch_size):        
+    def __init__(self, image_size, batch_size, device = 'cuda', cache_mb = 0, packed = False, num_workers = None):        
         super(SimpleDataManager, self).__init__()
+        self.image_size = image_size
         self.batch_size = batch_size
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
         self.trans_loader = TransformLoader(image_size)
+        self.pin_memory = torch.device(device).type == 'cuda' #pinned host memory only helps copies to a GPU
+        self.cache_bytes = int(cache_mb * 2**20) #decoded image cache shared by the loader workers, 0 to disable
+        self.packed = packed #read the pre-resized images written by pack_images.py instead of the JPEGs
 
     
-    def get_data_loader(self, data_file, aug): #parameters that would change on train/val set
+    def get_data_loader(self, data_file, aug, order = None): #parameters that would change on train/val set, order: dataset indices in loading order, None to shuffle
         
 
         transform = self.trans_loader.get_composed_transform(aug = aug)
-        dataset = SimpleDataset(data_file, transform = transform)
+        if self.packed:
+            dataset = PackedSimpleDataset(packed_file(data_file, self.trans_loader.resize_size), transform = transform)
+        else:
+            dataset = SimpleDataset(data_file, transform = transform, cache_bytes = self.cache_bytes)
 
-        data_loader_params = dict(batch_size = self.batch_size, shuffle = True, num_workers = os.cpu_count(), pin_memory = True) 
+        data_loader_params = dict(batch_size = self.batch_size, shuffle = order is None, sampler = order, num_workers = self.num_workers, pin_memory = self.pin_memory) 
 
         data_loader = torch.utils.data.DataLoader(dataset, **data_loader_params)
 
         return data_loader
 
 class SetDataManager(DataManager):
-    def __init__(self, image_size, n_way, n_support, n_query, n_eposide =100):        
+    def __init__(self, image_size, n_way, n_support, n_query, n_eposide =100, device = 'cuda', cache_mb = 0, packed = False, num_workers = None, legacy_sampler = False, prefetch_factor = 2, persistent_workers = False):        
         super(SetDataManager, self).__init__()
         self.image_size = image_size
         self.n_way = n_way
         self.batch_size = n_support + n_query
         self.n_eposide = n_eposide
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.legacy_sampler = legacy_sampler #SetDataset with one nested DataLoader per class, instead of EpisodeDataset with EpisodicSampler
+        self.prefetch_factor = prefetch_factor #episodes loaded in advance by each worker
+        self.persistent_workers = persistent_workers #keep the workers alive across epochs instead of spawning new ones every epoch
+        self.pin_memory = torch.device(device).type == 'cuda' #pinned host memory only helps copies to a GPU
+        self.cache_bytes = int(cache_mb * 2**20) #decoded image cache shared by the loader workers, 0 to disable
+        self.packed = packed #read the pre-resized images written by pack_images.py instead of the JPEGs
 
         self.trans_loader = TransformLoader(image_size)
 
+    def get_dataset(self, data_file, aug): #flat dataset the episodes are drawn from, one image per index
+        transform = self.trans_loader.get_composed_transform(aug = aug)
+        if self.packed:
+            return PackedSimpleDataset( packed_file(data_file, self.trans_loader.resize_size), transform = transform)
+        else:
+            return SimpleDataset( data_file, transform = transform, cache_bytes = self.cache_bytes)
+
     def get_data_loader(self, data_file, aug): #parameters that would change on train/val set
         
 
         transform = self.trans_loader.get_composed_transform(aug = aug)
-        dataset = SetDataset( data_file , self.batch_size, transform = transform)
-        sampler = EpisodicBatchSampler(len(dataset), self.n_way, self.n_eposide )  
-
-      
-        data_loader_params = dict(batch_sampler = sampler,  num_workers = os.cpu_count(), pin_memory = True)       
+        if self.legacy_sampler:
+            if self.packed:
+                dataset = PackedSetDataset( packed_file(data_file, self.trans_loader.resize_size), self.batch_size, transform = transform)
+            else:
+                dataset = SetDataset( data_file , self.batch_size, transform = transform, cache_bytes = self.cache_bytes)
+            sampler = EpisodicBatchSampler(len(dataset), self.n_way, self.n_eposide )  
+            data_loader_params = dict(batch_sampler = sampler)
+        else:
+            flat_dataset = self.get_dataset(data_file, aug)
+            dataset = EpisodeDataset(flat_dataset, self.n_way)
+            sampler = EpisodicSampler(flat_dataset.meta['image_labels'], self.n_way, self.batch_size, self.n_eposide )
+            data_loader_params = dict(sampler = sampler, batch_size = None) #every sampled index is a whole episode
+
+        data_loader_params.update(num_workers = self.num_workers, pin_memory = self.pin_memory)
+        if self.num_workers > 0:
+            data_loader_params.update(prefetch_factor = self.prefetch_factor, persistent_workers = self.persistent_workers)
+  
   
         data_loader = torch.utils.data.DataLoader(dataset, **data_loader_params)
         return data_loader
+
+    def get_episode_loader(self, data_file, aug, episode_ids): #loader over given episodes, episode_ids: [n_episodes, n_way, n_per_class] indices of the flat dataset (EpisodeManifest.image_ids)
+        dataset = EpisodeDataset(self.get_dataset(data_file, aug), self.n_way)
+        data_loader_params = dict(sampler = [ ids.reshape(-1).tolist() for ids in episode_ids ], batch_size = None, num_workers = self.num_workers, pin_memory = self.pin_memory)
+        if self.num_workers > 0:
+            data_loader_params.update(prefetch_factor = self.prefetch_factor, persistent_workers = self.persistent_workers)
+        return torch.utils.data.DataLoader(dataset, **data_loader_params)
+
+
+class FixedEpisodes:
+    #the first n_episodes episodes of an episodic loader, drawn once and kept in memory, iterated like the loader.
+    #Every epoch then validates on the same episodes without sampling, decoding or transforming them again.
+    #Holds n_episodes * n_way * (n_support + n_query) * 3 * image_size**2 float32 values
+    def __init__(self, loader, n_episodes):
+        self.episodes = list(itertools.islice(loader, n_episodes))
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def __iter__(self):
+        return iter(self.episodes)
@@ -7,6 +7,7 @@ import numpy as np
 import torchvision.transforms as transforms
 import os
 import configs
+from data.image_cache import SharedImageCache
 from typing import Callable, Optional, Tuple
 
 
@@ -14,17 +15,39 @@ def identity(x):
     return x
 
 
+def packed_file(data_file, size):
+    #index json written by pack_images.py next to a filelist json, e.g. base.json -> base_packed96.json
+    return os.path.splitext(data_file)[0] + '_packed%d.json' %(size)
+
+
+class PackedImages:
+    #uint8 [n_images, size, size, 3] array written by pack_images.py
+    #memory mapped on first access in every process, so DataLoader workers share the page cache instead of copies
+    def __init__(self, images_file):
+        self.images_file = images_file
+        self.images = None
+
+    def __getitem__(self, i):
+        if self.images is None:
+            self.images = np.load(self.images_file, mmap_mode = 'r')
+        return Image.fromarray(self.images[i])
+
+    def __getstate__(self):
+        return dict(images_file = self.images_file, images = None) #never pickle the mapped array into the workers
+
+
 class SimpleDataset:
-    def __init__(self, data_file, transform, target_transform=identity):
+    def __init__(self, data_file, transform, target_transform=identity, cache_bytes=0):
         with open(data_file, 'r') as f:
             self.meta = json.load(f)
         self.transform = transform
         self.target_transform = target_transform
+        self.cache = SharedImageCache(self.meta['image_names'], cache_bytes) if cache_bytes > 0 else None
    
 
     def __getitem__(self,i):
         image_path = os.path.join(self.meta['image_names'][i])
-        img = Image.open(image_path).convert('RGB')
+        img = self.cache.open(image_path) if self.cache is not None else Image.open(image_path).convert('RGB')
 
 
         img = self.transform(img)
@@ -36,10 +59,30 @@ class SimpleDataset:
 
 
 
+class PackedSimpleDataset:
+    #SimpleDataset reading pre-resized images from a packed index json instead of decoding JPEGs
+    def __init__(self, data_file, transform, target_transform=identity):
+        with open(data_file, 'r') as f:
+            self.meta = json.load(f)
+        self.images = PackedImages(os.path.join(os.path.dirname(data_file), self.meta['images_file']))
+        self.transform = transform
+        self.target_transform = target_transform
+
+    def __getitem__(self,i):
+        img = self.transform(self.images[i])
+        target = self.target_transform(self.meta['image_labels'][i])
+        return img, target
+
+    def __len__(self):
+        return len(self.meta['image_labels'])
+
+
+
 class SetDataset:
-    def __init__(self, data_file, batch_size, transform):
+    def __init__(self, data_file, batch_size, transform, cache_bytes=0):
         with open(data_file, 'r') as f:
             self.meta = json.load(f)
+        self.cache = SharedImageCache(self.meta['image_names'], cache_bytes) if cache_bytes > 0 else None #shared by all classes
  
         self.cl_list = np.unique(self.meta['image_labels']).tolist()
 
@@ -56,7 +99,38 @@ class SetDataset:
                                   num_workers = 0, #use main thread only or may receive multiple batches
                                   pin_memory = False)        
         for cl in self.cl_list:
-            sub_dataset = SubDataset(self.sub_meta[cl], cl, transform = transform )
+            sub_dataset = SubDataset(self.sub_meta[cl], cl, transform = transform, cache = self.cache )
+            self.sub_dataloader.append( torch.utils.data.DataLoader(sub_dataset, **sub_data_loader_params) )
+
+    def __getitem__(self,i):
+        return next(iter(self.sub_dataloader[i]))
+
+    def __len__(self):
+        return len(self.cl_list)
+
+class PackedSetDataset:
+    #SetDataset reading pre-resized images from a packed index json instead of decoding JPEGs
+    def __init__(self, data_file, batch_size, transform):
+        with open(data_file, 'r') as f:
+            self.meta = json.load(f)
+        self.images = PackedImages(os.path.join(os.path.dirname(data_file), self.meta['images_file']))
+
+        self.cl_list = np.unique(self.meta['image_labels']).tolist()
+
+        self.sub_meta = {}
+        for cl in self.cl_list:
+            self.sub_meta[cl] = []
+
+        for i, y in enumerate(self.meta['image_labels']):
+            self.sub_meta[y].append(i) #offsets into the packed array
+
+        self.sub_dataloader = [] 
+        sub_data_loader_params = dict(batch_size = batch_size,
+                                  shuffle = True,
+                                  num_workers = 0, #use main thread only or may receive multiple batches
+                                  pin_memory = False)        
+        for cl in self.cl_list:
+            sub_dataset = PackedSubDataset(self.images, self.sub_meta[cl], cl, transform = transform )
             self.sub_dataloader.append( torch.utils.data.DataLoader(sub_dataset, **sub_data_loader_params) )
 
     def __getitem__(self,i):
@@ -66,16 +140,17 @@ class SetDataset:
         return len(self.cl_list)
 
 class SubDataset:
-    def __init__(self, sub_meta, cl, transform=transforms.ToTensor(), target_transform=identity):
+    def __init__(self, sub_meta, cl, transform=transforms.ToTensor(), target_transform=identity, cache=None):
         self.sub_meta = sub_meta
         self.cl = cl 
         self.transform = transform
         self.target_transform = target_transform
+        self.cache = cache
 
    
     def __getitem__(self,i):
         image_path = os.path.join( self.sub_meta[i])
-        img = Image.open(image_path).convert('RGB')
+        img = self.cache.open(image_path) if self.cache is not None else Image.open(image_path).convert('RGB')
 
         img = self.transform(img)
         target = self.target_transform(self.cl)
@@ -85,6 +160,23 @@ class SubDataset:
         return len(self.sub_meta)
 
 
+class PackedSubDataset:
+    def __init__(self, images, sub_ids, cl, transform=transforms.ToTensor(), target_transform=identity):
+        self.images = images
+        self.sub_ids = sub_ids
+        self.cl = cl 
+        self.transform = transform
+        self.target_transform = target_transform
+
+    def __getitem__(self,i):
+        img = self.transform(self.images[self.sub_ids[i]])
+        target = self.target_transform(self.cl)
+        return img, target
+
+    def __len__(self):
+        return len(self.sub_ids)
+
+
 class EpisodicBatchSampler(object):
     def __init__(self, n_classes, n_way, n_episodes):
         self.n_classes = n_classes
@@ -97,3 +189,69 @@ class EpisodicBatchSampler(object):
     def __iter__(self):
         for i in range(self.n_episodes):
             yield torch.randperm(self.n_classes)[:self.n_way]
+
+
+class EpisodicSampler(object):
+    #sampler of EpisodeDataset: every index it yields is one episode over a flat dataset (SimpleDataset, PackedSimpleDataset),
+    #n_way classes with n_per_class distinct images each, class by class. Each class keeps a persistent permutation and a cursor into it,
+    #so drawing a class costs O(n_per_class) index arithmetic instead of a new shuffled DataLoader iterator (SetDataset)
+    def __init__(self, labels, n_way, n_per_class, n_episodes):
+        labels = np.asarray(labels)
+        self.cl_list = np.unique(labels)
+        self.n_way = n_way
+        self.n_per_class = n_per_class
+        self.n_episodes = n_episodes
+
+        order = np.argsort(labels, kind = 'stable')
+        bounds = np.searchsorted(labels[order], self.cl_list, side = 'right')
+        self.cl_ids = np.split(order, bounds[:-1]) #dataset indices of every class
+        for cl, ids in zip(self.cl_list, self.cl_ids):
+            if len(ids) < n_per_class:
+                raise ValueError(f'Class {cl} has {len(ids)} images, an episode needs {n_per_class} per class')
+
+        self.perm = [ np.random.permutation(ids) for ids in self.cl_ids ]
+        self.cursor = np.zeros(len(self.cl_list), dtype = np.int64)
+
+    def draw(self, c):
+        if self.cursor[c] + self.n_per_class > len(self.perm[c]): #pass over the class done, reshuffle
+            self.perm[c] = np.random.permutation(self.cl_ids[c])
+            self.cursor[c] = 0
+        ids = self.perm[c][self.cursor[c]: self.cursor[c] + self.n_per_class]
+        self.cursor[c] += self.n_per_class
+        return ids
+
+    def state_dict(self):
+        #class permutations and cursors, the classes of every episode come from the global numpy RNG (saved separately)
+        return dict(perm = [ torch.from_numpy(p) for p in self.perm ], cursor = torch.from_numpy(self.cursor.copy()))
+
+    def load_state_dict(self, state):
+        self.perm = [ p.cpu().numpy() for p in state['perm'] ] #on the device when the checkpoint was loaded with a device map_location
+        self.cursor = state['cursor'].cpu().numpy().copy()
+
+    def __len__(self):
+        return self.n_episodes
+
+    def __iter__(self):
+        for i in range(self.n_episodes):
+            classes = np.random.permutation(len(self.cl_list))[:self.n_way]
+            yield np.concatenate([ self.draw(c) for c in classes ]).tolist()
+
+
+class EpisodeDataset:
+    #whole episodes of a flat dataset, indexed by the index lists of EpisodicSampler (use with batch_size = None),
+    #so one loader worker builds the complete [n_way, n_per_class, C, H, W] episode, the layout of SetDataset
+    def __init__(self, dataset, n_way):
+        self.dataset = dataset
+        self.n_way = n_way
+        self.cache = getattr(dataset, 'cache', None)
+
+    def __getitem__(self, ids):
+        x = None
+        y = torch.empty(len(ids), dtype = torch.int64)
+        for k, i in enumerate(ids):
+            img, target = self.dataset[i]
+            if x is None:
+                x = torch.empty(len(ids), *img.size(), dtype = img.dtype)
+            x[k] = img
+            y[k] = target
+        return x.view(self.n_way, -1, *x.size()[1:]), y.view(self.n_way, -1)
@@ -1,6 +1,8 @@
 import torch
 import numpy as np
 import h5py
+import os
+from collections.abc import Mapping
 
 class SimpleHDF5Dataset:
     def __init__(self, file_handle = None):
@@ -8,7 +10,7 @@ class SimpleHDF5Dataset:
             self.f = ''
             self.all_feats_dset = []
             self.all_labels = []
-            self.total = 0 
+            self.total = 0
         else:
             self.f = file_handle
             self.all_feats_dset = self.f['all_feats'][...]
@@ -21,24 +23,63 @@ class SimpleHDF5Dataset:
     def __len__(self):
         return self.total
 
-def init_loader(filename):
+class ClassFeatures(Mapping):
+    #features grouped by class, read like the former {class: [feature, ...]} dict: cl_data_file[cl] is a [size, dim] array.
+    #All rows live in one contiguous [n, dim] array sorted by class, class class_list[i] is feats[offsets[i]: offsets[i] + sizes[i]].
+    #filelist_order: the rows of every class are in filelist order (features saved with their filelist ids), so an episode manifest can address them
+    def __init__(self, feats, class_list, offsets, sizes, filelist_order = False):
+        self.feats = feats
+        self.filelist_order = filelist_order
+        self.class_list = class_list
+        self.offsets = offsets
+        self.sizes = sizes
+        self.index = { cl: i for i, cl in enumerate(class_list) }
+
+    def __getitem__(self, cl):
+        i = self.index[cl]
+        return self.feats[self.offsets[i]: self.offsets[i] + self.sizes[i]]
+
+    def __iter__(self):
+        return iter(self.class_list)
+
+    def __len__(self):
+        return len(self.class_list)
+
+def read_sorted(all_feats, order, out, chunk_rows = 4096):
+    #out[k] = all_feats[order[k]], reading all_feats sequentially chunk by chunk so only chunk_rows rows are in memory at a time
+    position = np.empty(len(order), dtype = np.int64)
+    position[order] = np.arange(len(order))
+    for start in range(0, len(order), chunk_rows):
+        stop = min(start + chunk_rows, len(order)) #all_feats may hold padding rows past len(order)
+        out[position[start: stop]] = all_feats[start: stop]
+    return out
+
+def init_loader(filename, mmap = False):
+    #mmap: keep the sorted features in a <filename>_sorted.npy sidecar, written on first use, and memory-map it
     with h5py.File(filename, 'r') as f:
-        fileset = SimpleHDF5Dataset(f)
-
-    #labels = [ l for l  in fileset.all_labels if l != 0]
-    feats = fileset.all_feats_dset
-    labels = fileset.all_labels
-    while np.sum(feats[-1]) == 0:
-        feats  = np.delete(feats,-1,axis = 0)
-        labels = np.delete(labels,-1,axis = 0)
-        
-    class_list = np.unique(np.array(labels)).tolist() 
-    inds = range(len(labels))
-
-    cl_data_file = {}
-    for cl in class_list:
-        cl_data_file[cl] = []
-    for ind in inds:
-        cl_data_file[labels[ind]].append( feats[ind])
-
-    return cl_data_file
+        count = int(f['count'][0]) #rows past count are padding
+        labels = f['all_labels'][:count]
+        filelist_order = 'all_ids' in f
+        if filelist_order:
+            order = np.lexsort((f['all_ids'][:count], labels)) #by class, then by filelist index
+        else:
+            order = np.argsort(labels, kind = 'stable')
+        shape = (count,) + f['all_feats'].shape[1:]
+        dtype = np.promote_types(f['all_feats'].dtype, np.float32) #features stored as float16 are read as float32
+
+        if mmap:
+            sorted_file = os.path.splitext(filename)[0] + '_sorted.npy'
+            feats = None
+            if os.path.isfile(sorted_file) and os.path.getmtime(sorted_file) >= os.path.getmtime(filename):
+                feats = np.load(sorted_file, mmap_mode = 'r')
+                if feats.shape != shape or feats.dtype != dtype: #stale sidecar
+                    feats = None
+            if feats is None:
+                feats = read_sorted(f['all_feats'], order, np.lib.format.open_memmap(sorted_file, mode = 'w+', dtype = dtype, shape = shape))
+                feats.flush()
+                feats = np.load(sorted_file, mmap_mode = 'r')
+        else:
+            feats = read_sorted(f['all_feats'], order, np.empty(shape, dtype = dtype))
+
+    class_list, offsets, sizes = np.unique(labels[order], return_index = True, return_counts = True)
+    return ClassFeatures(feats, class_list.tolist(), offsets, sizes, filelist_order = filelist_order)
@@ -0,0 +1,86 @@
+import math
+import multiprocessing
+import numpy as np
+import torch
+from PIL import Image
+
+
+class SharedImageCache:
+    #LRU cache of decoded RGB images, bounded by bytes and shared by the main process and all DataLoader workers.
+    #It only replaces Image.open(path).convert('RGB'): transforms, random augmentations included, still run on every access.
+    #Pixels are stored in fixed size pages of one shared memory arena, bookkeeping lives in small shared tensors,
+    #so workers started with spawn (or fork) all read and fill the same cache across epochs.
+    def __init__(self, image_names, capacity_bytes, page_bytes = 64*1024):
+        self.index = { name: i for i, name in enumerate(image_names) }
+        self.page_bytes = page_bytes
+        self.n_pages = max(1, int(capacity_bytes // page_bytes))
+
+        self.arena = torch.empty(self.n_pages, page_bytes, dtype = torch.uint8).share_memory_()
+        self.page_owner = torch.full((self.n_pages,), -1, dtype = torch.int64).share_memory_() #image index stored in each page, -1 if free
+        self.entry = torch.zeros(len(image_names), 3, dtype = torch.int64).share_memory_() #height, width, last use (0 if not cached)
+        self.counters = torch.zeros(4, dtype = torch.int64).share_memory_() #clock, hits, misses, evictions
+        self.lock = multiprocessing.Lock()
+
+    def open(self, path):
+        i = self.index.get(path)
+        if i is None:
+            return Image.open(path).convert('RGB')
+
+        with self.lock:
+            img = self.get(i)
+        if img is not None:
+            return Image.fromarray(img)
+
+        img = Image.open(path).convert('RGB') #decode outside the lock, other workers keep hitting the cache meanwhile
+        with self.lock:
+            self.put(i, np.asarray(img))
+        return img
+
+    def get(self, i): #call with self.lock held
+        entry = self.entry.numpy()
+        counters = self.counters.numpy()
+        if entry[i, 2] == 0:
+            counters[2] += 1
+            return None
+        counters[0] += 1
+        counters[1] += 1
+        entry[i, 2] = counters[0]
+
+        h, w = entry[i, 0], entry[i, 1]
+        pages = np.flatnonzero(self.page_owner.numpy() == i) #pages are written in ascending order
+        return self.arena.numpy()[pages].reshape(-1)[:h*w*3].reshape(h, w, 3) #fancy indexing copies, safe to use after the lock is released
+
+    def put(self, i, img): #call with self.lock held
+        entry = self.entry.numpy()
+        counters = self.counters.numpy()
+        owner = self.page_owner.numpy()
+        n_need = int(math.ceil(img.nbytes / self.page_bytes))
+        if entry[i, 2] != 0 or n_need > self.n_pages: #filled by another worker meanwhile, or larger than the whole cache
+            return
+
+        free = np.flatnonzero(owner == -1)
+        while len(free) < n_need: #evict least recently used images until the new one fits
+            cached = np.flatnonzero(entry[:, 2])
+            victim = cached[np.argmin(entry[cached, 2])]
+            entry[victim, 2] = 0
+            owner[owner == victim] = -1
+            counters[3] += 1
+            free = np.flatnonzero(owner == -1)
+
+        pages = free[:n_need]
+        padded = np.empty(n_need * self.page_bytes, dtype = np.uint8)
+        padded[:img.nbytes] = img.reshape(-1)
+        self.arena.numpy()[pages] = padded.reshape(n_need, self.page_bytes)
+        owner[pages] = i
+        counters[0] += 1
+        entry[i] = (img.shape[0], img.shape[1], counters[0])
+
+    def stats(self):
+        clock, hits, misses, evictions = self.counters.tolist()
+        return dict(hits = hits,
+                    misses = misses,
+                    hit_rate = hits / max(1, hits + misses),
+                    evictions = evictions,
+                    cached_images = int((self.entry[:, 2] > 0).sum()),
+                    used_bytes = int((self.page_owner >= 0).sum()) * self.page_bytes,
+                    capacity_bytes = self.n_pages * self.page_bytes)
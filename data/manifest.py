@@ -0,0 +1,79 @@
+import os
+import numpy as np
+
+
+class EpisodeManifest:
+    #the test episodes of a split, generated once per (split, n_way, n_per_class, iter_num, seed) and saved to a .npz,
+    #so every method and checkpoint is scored on the same episodes, from images (test.py on maml variants) or saved features:
+    #  classes      [iter_num, n_way] int32, class of each way, an index into class_list
+    #  samples      [iter_num, n_way, n_per_class] int32, position of each image within its class in filelist order,
+    #               the first n_support of every way are the support set
+    #  class_list   sorted labels of the split, class_sizes their image counts, checked against the split on load
+    #Episode i only depends on (seed, i): n_way distinct classes and n_per_class distinct images of each
+    def __init__(self, classes, samples, class_list, class_sizes):
+        self.classes = classes
+        self.samples = samples
+        self.class_list = class_list
+        self.class_sizes = class_sizes
+
+    @classmethod
+    def generate(cls, labels, n_way, n_per_class, iter_num, seed = 10):
+        class_list, class_sizes = np.unique(labels, return_counts = True)
+        if len(class_list) < n_way:
+            raise ValueError(f'{len(class_list)} classes, an episode needs {n_way}')
+        if class_sizes.min() < n_per_class:
+            raise ValueError(f'Class {class_list[np.argmin(class_sizes)]} has {class_sizes.min()} images, an episode needs {n_per_class} per class')
+
+        classes = np.empty((iter_num, n_way), dtype = np.int32)
+        samples = np.empty((iter_num, n_way, n_per_class), dtype = np.int32)
+        for i in range(iter_num):
+            rng = np.random.default_rng([seed, i])
+            classes[i] = rng.choice(len(class_list), n_way, replace = False)
+            for w, c in enumerate(classes[i]):
+                samples[i, w] = rng.choice(class_sizes[c], n_per_class, replace = False)
+        return cls(classes, samples, class_list, class_sizes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['classes'], f['samples'], f['class_list'], f['class_sizes'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, classes = self.classes, samples = self.samples, class_list = self.class_list, class_sizes = self.class_sizes)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.classes)
+
+    def check(self, class_list, class_sizes):
+        if not (np.array_equal(class_list, self.class_list) and np.array_equal(class_sizes, self.class_sizes)):
+            raise ValueError('The episode manifest was generated for other classes or class sizes, delete it to generate a new one')
+
+    def image_ids(self, labels):
+        #[iter_num, n_way, n_per_class] indices into a filelist with these labels (SimpleDataset, PackedSimpleDataset)
+        labels = np.asarray(labels)
+        order = np.argsort(labels, kind = 'stable') #images of every class in filelist order
+        class_list, offsets, class_sizes = np.unique(labels[order], return_index = True, return_counts = True)
+        self.check(class_list, class_sizes)
+        return order[offsets[self.classes][..., None] + self.samples]
+
+    def feature_ids(self, cl_data_file):
+        #[iter_num, n_way, n_per_class] rows of the class sorted features of data.feature_loader.init_loader
+        if not cl_data_file.filelist_order:
+            raise ValueError('The features were saved without their filelist ids, run save_features.py again to test them on an episode manifest')
+        self.check(np.asarray(cl_data_file.class_list), cl_data_file.sizes)
+        return cl_data_file.offsets[self.classes][..., None] + self.samples
+
+
+def get_manifest(path, labels, n_way, n_per_class, iter_num, seed = 10):
+    #the manifest saved at path, generated and saved first if it does not exist
+    if os.path.isfile(path):
+        manifest = EpisodeManifest.load(path)
+    else:
+        manifest = EpisodeManifest.generate(labels, n_way, n_per_class, iter_num, seed)
+        manifest.save(path)
+    if manifest.samples.shape[1:] != (n_way, n_per_class) or len(manifest) != iter_num:
+        raise ValueError(f'{path} holds {manifest.samples.shape} episodes, expected {(iter_num, n_way, n_per_class)}')
+    return manifest
@@ -27,6 +27,12 @@ def parse_args(script):
     parser.add_argument('--n_shot'      , default=1, type=int,  help='number of labeled data in each class, same as n_support') #baseline and baseline++ only use this parameter in finetuning
     parser.add_argument('--train_aug'   , default='none', type=str, help='perform data augmentation or not during training, aug: none, standard') #still required for save_features.py and test.py to find the model path correctly
     parser.add_argument('--tra'   , default='none', type=str, help='TRA configurations: min_step-max_step-width')
+    parser.add_argument('--device'      , default='cuda' if torch.cuda.is_available() else 'cpu', type=str, help='device to run the model on: cuda, cuda:N or cpu')
+    parser.add_argument('--image_cache_mb', default=0, type=int, help='size of the decoded image cache shared by the loader workers in MB, 0 to disable')
+    parser.add_argument('--packed'      , action='store_true', help='read the pre-resized images written by pack_images.py instead of decoding the JPEGs')
+    parser.add_argument('--num_workers' , default=None, type=int, help='data loader worker processes (image packing processes for pack_images), default one per CPU')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='episodes loaded in advance by each data loader worker')
+    parser.add_argument('--persistent_workers', action='store_true', help='keep the episodic data loader workers alive across epochs')
 
 
     if script == 'train':
@@ -37,14 +43,37 @@ def parse_args(script):
         parser.add_argument('--start_epoch' , default=0, type=int,help ='Starting epoch')
         parser.add_argument('--stop_epoch'  , default=-1, type=int, help ='Stopping epoch') #for meta-learning methods, each epoch contains 100 episodes. The default epoch number is dataset dependent. See train.py
         parser.add_argument('--resume'      , action='store_true', help='continue from previous trained model with largest epoch')
+        parser.add_argument('--val_episodes', default=0, type=int, help='validate on the same N episodes every time, drawn once and kept in memory. 0 to sample fresh episodes')
+        parser.add_argument('--val_freq'    , default=1, type=int, help='validate every N epochs (and in the last one), early stopping patience is still counted in epochs')
+        parser.add_argument('--keep_checkpoints', default=0, type=int, help='keep only the last N <epoch>.tar checkpoints besides best_model.tar, 0 to keep all')
+        parser.add_argument('--batch_tasks' , action='store_true', help='maml/tra_maml only: adapt all tasks of a meta-batch at once with vmapped fast weights')
+        parser.add_argument('--second_order_steps', default=-1, type=int, help='maml/tra_maml only: backpropagate second order terms through only the last N inner steps, earlier ones are first order. -1 for all')
+        parser.add_argument('--first_order_epochs', default=0, type=int, help='maml/tra_maml only: first order adaptation for the first N epochs, second order after')
+        parser.add_argument('--tra_budget_hours', default=0, type=float, help='tra_maml only: reshape the TRA trapezoid so training (and validation) fits in this many hours, from the measured cost per inner step. 0 to disable')
+        parser.add_argument('--profile'     , default='none', help='per epoch timing of data wait, inner loop (per inner step), outer backward and optimizer: none, log (training_logs.txt) or jsonl (profile.jsonl)')
+        parser.add_argument('--profile_allocations', action='store_true', help='with --profile on CPU, also count the bytes allocated by every op (slow)')
 
     elif script == 'save_features':
         parser.add_argument('--split'       , default='novel', help='base/val/novel') #default novel, but you can also test base/val class accuracy if you want 
         parser.add_argument('--save_iter', default=-1, type=int,help ='save feature from the model trained in x epoch, use the best model if x is -1')
+        parser.add_argument('--float16'     , action='store_true', help='store the features as float16, half the file size')
+        parser.add_argument('--compression' , default='lzf', help='hdf5 compression of the feature file: none, lzf or gzip')
     elif script == 'test':
         parser.add_argument('--split'       , default='novel', help='base/val/novel') #default novel, but you can also test base/val class accuracy if you want 
         parser.add_argument('--save_iter', default=-1, type=int,help ='saved feature from the model trained in x epoch, use the best model if x is -1')
         parser.add_argument('--adaptation'  , action='store_true', help='further adaptation in test time or not')
+        parser.add_argument('--iter_num'    , default=600, type=int, help='number of test episodes')
+        parser.add_argument('--episode_batch', default=100, type=int, help='episodes evaluated per batched call for protonet/matchingnet features')
+        parser.add_argument('--episode_seed', default=10, type=int, help='seed of the episode manifest, the test episodes shared by every method and checkpoint tested on a split')
+        parser.add_argument('--finetune'    , default='sgd', choices=['sgd', 'full_batch', 'lbfgs', 'ridge'], help='baseline/baseline++ only: head training, sgd per episode (minibatches of 4), or batched over --episode_batch episodes: full_batch SGD, L-BFGS or closed form ridge regression')
+        parser.add_argument('--ridge_lambda', default=0.1, type=float, help='ridge penalty of --finetune ridge, relative to the mean squared norm of the support features')
+        parser.add_argument('--feature_test', action='store_true', help='maml/tra_maml only: test on features saved by save_features.py, adapting only the classifier. A fast proxy of the full adaptation')
+        parser.add_argument('--test_workers', default=0, type=int, help='maml/tra_maml only: evaluate the episodes of the episode manifest on a pool of N processes, each one on its own so results do not depend on N. 0 to use the episode loader in this process')
+        parser.add_argument('--threads_per_worker', default=1, type=int, help='torch threads of each --test_workers process')
+        parser.add_argument('--mmap_features', action='store_true', help='memory-map the class sorted features from a .npy file next to the hdf5 instead of reading them into memory')
+    elif script == 'pack_images':
+        parser.add_argument('--split'       , default='all', help='base/val/novel/all') 
+        parser.add_argument('--if_missing'  , action='store_true', help='skip filelists whose packed images are already up to date')
 
     else:
        raise ValueError('Unknown script')
@@ -7,9 +7,11 @@ import torch.nn.functional as F
 from methods.meta_template import MetaTemplate
 
 class BaselineFinetune(MetaTemplate):
-    def __init__(self, model_func,  n_way, n_support, loss_type = "softmax"):
+    def __init__(self, model_func,  n_way, n_support, loss_type = "softmax", solver = 'sgd', ridge_lambda = 0.1):
         super(BaselineFinetune, self).__init__( model_func,  n_way, n_support)
         self.loss_type = loss_type
+        self.solver = solver #head training of set_forward_batch: full_batch, lbfgs or ridge, see train_heads
+        self.ridge_lambda = ridge_lambda #ridge penalty, relative to the mean squared norm of the support features
 
     def set_forward(self,x,is_feature = True):
         return self.set_forward_adaptation(x,is_feature); #Baseline always do adaptation
@@ -21,19 +23,17 @@ class BaselineFinetune(MetaTemplate):
         z_support   = z_support.contiguous().view(self.n_way* self.n_support, -1 )
         z_query     = z_query.contiguous().view(self.n_way* self.n_query, -1 )
 
-        y_support = torch.from_numpy(np.repeat(range( self.n_way ), self.n_support ))
-        y_support = Variable(y_support.cuda())
+        y_support = self.get_label(self.n_support)
 
         if self.loss_type == 'softmax':
             linear_clf = nn.Linear(self.feat_dim, self.n_way)
         elif self.loss_type == 'dist':        
             linear_clf = backbone.distLinear(self.feat_dim, self.n_way)
-        linear_clf = linear_clf.cuda()
+        linear_clf = linear_clf.to(self.device)
 
         set_optimizer = torch.optim.SGD(linear_clf.parameters(), lr = 0.01, momentum=0.9, dampening=0.9, weight_decay=0.001)
 
         loss_function = nn.CrossEntropyLoss()
-        loss_function = loss_function.cuda()
         
         batch_size = 4
         support_size = self.n_way* self.n_support
@@ -41,7 +41,7 @@ class BaselineFinetune(MetaTemplate):
             rand_id = np.random.permutation(support_size)
             for i in range(0, support_size , batch_size):
                 set_optimizer.zero_grad()
-                selected_id = torch.from_numpy( rand_id[i: min(i+batch_size, support_size) ]).cuda()
+                selected_id = torch.from_numpy( rand_id[i: min(i+batch_size, support_size) ]).to(self.device)
                 z_batch = z_support[selected_id]
                 y_batch = y_support[selected_id] 
                 scores = linear_clf(z_batch)
@@ -52,6 +52,103 @@ class BaselineFinetune(MetaTemplate):
         return scores
 
 
+    def head_scores(self, z, weight, bias, scale):
+        #scores of the heads of a batch of episodes, z: [n_episode, n, feat_dim], weight: [n_episode, n_way, feat_dim]
+        if self.loss_type == 'softmax':
+            return torch.baddbmm(bias.unsqueeze(1), z, weight.transpose(1, 2))
+        else: #distLinear: cosine of the normalized features with the weight normalized class by class, times a learnable norm (scale)
+            z = z / (z.norm(dim = 2, keepdim = True) + 0.00001)
+            weight = scale * weight / weight.norm(dim = 2, keepdim = True)
+            scale_factor = 2 if self.n_way <= 200 else 10 #as in distLinear
+            return scale_factor * z.bmm(weight.transpose(1, 2))
+
+    def init_heads(self, n_episode):
+        #fresh heads initialized like nn.Linear / distLinear: uniform(-1/sqrt(feat_dim), 1/sqrt(feat_dim)), and the weight norm as scale.
+        #Drawn episode by episode, so the heads of an episode do not depend on --episode_batch
+        bound = 1 / np.sqrt(self.feat_dim)
+        weight = torch.empty(n_episode, self.n_way, self.feat_dim, device = self.device)
+        bias = torch.empty(n_episode, self.n_way, device = self.device)
+        for e in range(n_episode):
+            weight[e].uniform_(-bound, bound)
+            bias[e].uniform_(-bound, bound)
+        scale = weight.norm(dim = 2, keepdim = True)
+        return weight.requires_grad_(), bias.requires_grad_(), scale.requires_grad_()
+
+    def head_loss(self, z_support, y_support, weight, bias, scale):
+        #sum of the per-episode mean cross entropy losses of the support sets
+        scores = self.head_scores(z_support, weight, bias, scale)
+        return F.cross_entropy(scores.reshape(-1, self.n_way), y_support.repeat(z_support.size(0))) * z_support.size(0)
+
+    def train_heads(self, z_support, y_support):
+        #heads of a batch of episodes trained on their full support sets, [n_episode, n_way, feat_dim] weights. Every
+        #episode's head only depends on its own support set, not on the other episodes of the batch:
+        #  full_batch  the SGD recipe of set_forward_adaptation (lr 0.01, momentum 0.9, dampening 0.9, weight decay 0.001) with
+        #              the same number of updates, 100 epochs of ceil(support/4) steps, each on the whole support set. Run on all
+        #              heads at once, SGD updates every coordinate on its own gradient
+        #  lbfgs       L-BFGS (strong Wolfe line search) on the same loss plus the weight decay as an L2 penalty, one run per
+        #              episode, since the line search, curvature history and stopping tests would otherwise be shared
+        n_episode, support_size = z_support.size()[:2]
+        weight, bias, scale = self.init_heads(n_episode)
+
+        if self.solver == 'full_batch':
+            params = [weight, scale] if self.loss_type == 'dist' else [weight, bias]
+            optimizer = torch.optim.SGD(params, lr = 0.01, momentum=0.9, dampening=0.9, weight_decay=0.001)
+            for step in range(100* int(np.ceil(support_size / 4))):
+                optimizer.zero_grad()
+                self.head_loss(z_support, y_support, weight, bias, scale).backward()
+                optimizer.step()
+        elif self.solver == 'lbfgs':
+            heads = [ self.train_head_lbfgs(z_support[e:e+1], y_support, weight[e:e+1], bias[e:e+1], scale[e:e+1]) for e in range(n_episode) ]
+            weight, bias, scale = [ torch.cat(h) for h in zip(*heads) ]
+        else:
+            raise ValueError(f'Unknown head solver: {self.solver}')
+        return weight.detach(), bias.detach(), scale.detach()
+
+    def train_head_lbfgs(self, z_support, y_support, weight, bias, scale):
+        #head of one episode, z_support: [1, n_way* n_support, feat_dim]
+        weight, bias, scale = [ p.detach().clone().requires_grad_() for p in (weight, bias, scale) ]
+        params = [weight, scale] if self.loss_type == 'dist' else [weight, bias]
+        optimizer = torch.optim.LBFGS(params, lr = 1, max_iter = 100, history_size = 10, line_search_fn = 'strong_wolfe')
+        def closure():
+            optimizer.zero_grad()
+            loss = self.head_loss(z_support, y_support, weight, bias, scale) + 0.0005* sum( (p**2).sum() for p in params )
+            loss.backward()
+            return loss
+        optimizer.step(closure)
+        return weight, bias, scale
+
+    def ridge_scores(self, z_support, y_support, z_query):
+        #closed form ridge regression of the one-hot support labels with an unpenalized bias, in kernel form since n_support << feat_dim:
+        #features centered on the support mean, scores = k(query, support) (K + lambda I)^-1 (Y - 1/n_way) + 1/n_way.
+        #baseline++ regresses the normalized features, like the cosine scores of distLinear
+        if self.loss_type == 'dist':
+            z_support = z_support / (z_support.norm(dim = 2, keepdim = True) + 0.00001)
+            z_query = z_query / (z_query.norm(dim = 2, keepdim = True) + 0.00001)
+        mean = z_support.mean(1, keepdim = True)
+        z_support = z_support - mean
+        z_query = z_query - mean
+        n_episode, support_size = z_support.size()[:2]
+        Y = F.one_hot(y_support, self.n_way).to(z_support.dtype).expand(n_episode, -1, -1) - 1 / self.n_way #balanced support, so the mean of every column is 1/n_way
+        K = z_support.bmm(z_support.transpose(1, 2))
+        penalty = self.ridge_lambda * K.diagonal(dim1 = 1, dim2 = 2).mean(1) #relative to the mean squared feature norm, so feature scale does not matter
+        K = K + penalty[:, None, None] * torch.eye(support_size, device = K.device, dtype = K.dtype)
+        alpha = torch.linalg.solve(K, Y)
+        return z_query.bmm(z_support.transpose(1, 2)).bmm(alpha) + 1 / self.n_way
+
+    def set_forward_batch(self, x, is_feature = True):
+        #x: [n_episode, n_way, n_support + n_query, feat_dim], the heads of all episodes are trained together by self.solver
+        assert is_feature == True, 'Baseline only support testing with feature'
+        x = x.to(self.device)
+        n_episode = x.size(0)
+        z_support = x[:,:,:self.n_support].reshape( n_episode, self.n_way* self.n_support, -1)
+        z_query = x[:,:,self.n_support:].reshape( n_episode, self.n_way* self.n_query, -1)
+        y_support = self.get_label(self.n_support)
+        if self.solver == 'ridge':
+            return self.ridge_scores(z_support, y_support, z_query)
+        with torch.enable_grad(): #test.py evaluates batches under no_grad
+            weight, bias, scale = self.train_heads(z_support, y_support)
+        return self.head_scores(z_query, weight, bias, scale)
+
     def set_forward_loss(self,x):
         raise ValueError('Baseline predict on pretrained feature and do not support finetune backbone')
         
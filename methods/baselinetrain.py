@@ -20,27 +20,43 @@ class BaselineTrain(nn.Module):
         self.num_class = num_class
         self.loss_fn = nn.CrossEntropyLoss()
         self.DBval = False; #only set True for CUB dataset, see issue #31
+        self.profiler = None #profiling.Profiler timing the train loop, None to disable
+
+    @property
+    def device(self):
+        return next(self.parameters()).device #follows model.to(device)
 
     def forward(self,x):
-        x    = Variable(x.cuda())
+        x    = Variable(x.to(self.device))
         out  = self.feature.forward(x)
         scores  = self.classifier.forward(out)
         return scores
 
     def forward_loss(self, x, y):
         scores = self.forward(x)
-        y = Variable(y.cuda())
+        y = Variable(y.to(self.device))
         return self.loss_fn(scores, y )
     
     def train_loop(self, epoch, train_loader, optimizer):
         print_freq = 10
         avg_loss=0
+        prof = self.profiler
+        if prof is not None:
+            t = prof.tic()
 
         for i, (x,y) in enumerate(train_loader):
+            if prof is not None:
+                t = prof.lap('data', t)
             optimizer.zero_grad()
             loss = self.forward_loss(x, y)
+            if prof is not None:
+                t = prof.lap('inner_loop', t)
             loss.backward()
+            if prof is not None:
+                t = prof.lap('outer_backward', t)
             optimizer.step()
+            if prof is not None:
+                t = prof.lap('optimizer', t)
 
             avg_loss = avg_loss+loss.item()
 
@@ -57,7 +73,7 @@ class BaselineTrain(nn.Module):
     def analysis_loop(self, val_loader, record = None):
         class_file  = {}
         for i, (x,y) in enumerate(val_loader):
-            x = x.cuda()
+            x = x.to(self.device)
             x_var = Variable(x)
             feats = self.feature.forward(x_var).data.cpu().numpy()
             labels = y.cpu().numpy()
@@ -0,0 +1,95 @@
+# Inner loop shared by MAML and TRA_MAML: the order of each inner step (first / second order) and the batched
+# adaptation of several tasks at once (--batch_tasks, test.py --feature_test). Mixed in before MetaTemplate:
+#   class MAML(BatchedInnerLoop, MetaTemplate)
+# and reads loss_fn, classifier, train_lr, task_update_num, approx, second_order_steps, first_order_epochs and
+# current_epoch from the model.
+
+import torch
+import torch.nn.functional as F
+from torch.func import vmap
+
+
+class BatchedInnerLoop:
+    def set_task_update_num(self):
+        pass #task_update_num is fixed, TRA_MAML sets it from its schedule before every inner loop
+
+    def first_order(self):
+        return self.approx or self.current_epoch < self.first_order_epochs
+
+    def create_graph(self, task_step):
+        #whether the gradient of inner step task_step is differentiated again by the meta update. Earlier steps are first
+        #order, so their graphs are freed as soon as the step is taken. Evaluation never runs the meta update
+        if self.first_order() or not self.training:
+            return False
+        return self.second_order_steps is None or task_step >= self.task_update_num - self.second_order_steps
+
+    def forward_fast(self, fast_parameters, x): #forward one task with its own fast weights, vmapped over the task dimension in set_forward_batch
+        for weight, fast in zip(self.parameters(), fast_parameters):
+            weight.fast = fast
+        return self.forward(x)
+
+    def set_forward_batch(self, x, is_feature = False): #x: [n_task, n_way, n_support + n_query, dim, w, h], all tasks are adapted together
+        if is_feature: #saved features, test.py --feature_test
+            return self.set_forward_head_batch(x)
+        x = x.to(self.device)
+        n_task = x.size(0)
+        x_a = x[:,:,:self.n_support,:,:,:].contiguous().view( n_task, self.n_way* self.n_support, *x.size()[3:]) #support data
+        x_b = x[:,:,self.n_support:,:,:,:].contiguous().view( n_task, self.n_way* self.n_query,   *x.size()[3:]) #query data
+        y_a = self.get_label(self.n_support, n_task) #label for support data of every task
+
+        forward_fast = vmap(self.forward_fast)
+        fast_parameters = [ weight.unsqueeze(0).expand(n_task, *weight.size()) for weight in self.parameters() ] #every task starts from the original weight
+        self.zero_grad()
+
+        self.set_task_update_num()
+
+        prof = self.profiler
+        try:
+            for task_step in range(self.task_update_num):
+                if prof is not None:
+                    t = prof.tic()
+                scores = forward_fast(fast_parameters, x_a)
+                set_loss = self.loss_fn( scores.view(-1, self.n_way), y_a) * n_task #sum of per-task mean losses, so each slice of fast_parameters gets its own task gradient
+                create_graph = self.create_graph(task_step)
+                grad = torch.autograd.grad(set_loss, fast_parameters, create_graph=create_graph) #build full graph support gradient of gradient
+                if not create_graph:
+                    grad = [ g.detach()  for g in grad ] #do not calculate gradient of gradient if using first order approximation
+                fast_parameters = [ fast - self.train_lr * g for fast, g in zip(fast_parameters, grad) ]
+                if prof is not None:
+                    prof.inner_step(task_step, prof.tic() - t)
+
+            # feed forward query data
+            scores = forward_fast(fast_parameters, x_b)
+        finally:
+            for weight in self.parameters():
+                weight.fast = None #do not leave the per-task tensors of vmap behind in weight.fast
+
+        return scores
+
+    def set_forward_head_batch(self, z): #z: [n_episode, n_way, n_support + n_query, feat_dim] features of the frozen trunk, only the classifier is adapted, all episodes together
+        z = z.to(self.device)
+        n_episode = z.size(0)
+        z_a = z[:,:,:self.n_support].reshape( n_episode, self.n_way* self.n_support, -1) #support features
+        z_b = z[:,:,self.n_support:].reshape( n_episode, self.n_way* self.n_query,   -1) #query features
+        y_a = F.one_hot(self.get_label(self.n_support), self.n_way).to(z.dtype) #label for support data
+
+        self.set_task_update_num()
+
+        weight = self.classifier.weight.detach().expand(n_episode, -1, -1) #every episode starts from the meta-learned head
+        bias = self.classifier.bias.detach().expand(n_episode, -1)
+        for task_step in range(self.task_update_num):
+            scores = torch.baddbmm(bias.unsqueeze(1), z_a, weight.transpose(1, 2))
+            grad_scores = (F.softmax(scores, dim = 2) - y_a) / z_a.size(1) #gradient of the mean cross entropy of each episode, the inner loop of set_forward on a linear head
+            weight = weight - self.train_lr * grad_scores.transpose(1, 2).bmm(z_a)
+            bias = bias - self.train_lr * grad_scores.sum(1)
+
+        # feed forward query data
+        scores = torch.baddbmm(bias.unsqueeze(1), z_b, weight.transpose(1, 2))
+        return scores
+
+    def set_forward_loss_batch(self, x):
+        scores = self.set_forward_batch(x)
+        y_b = self.get_label(self.n_query, x.size(0))
+        loss = self.loss_fn(scores.view(-1, self.n_way), y_b) * x.size(0) #same as summing the loss of each task
+
+        return loss
@@ -7,11 +7,12 @@ from torch.autograd import Variable
 import numpy as np
 import torch.nn.functional as F
 from methods.meta_template import MetaTemplate
+from methods.batched_inner_loop import BatchedInnerLoop
 from tqdm import tqdm
 
 
-class MAML(MetaTemplate):
-    def __init__(self, model_func,  n_way, n_support, approx = False):
+class MAML(BatchedInnerLoop, MetaTemplate):
+    def __init__(self, model_func,  n_way, n_support, approx = False, batch_tasks = False, second_order_steps = None, first_order_epochs = 0):
         super(MAML, self).__init__( model_func,  n_way, n_support, change_way = False)
 
         self.loss_fn = nn.CrossEntropyLoss()
@@ -22,10 +23,17 @@ class MAML(MetaTemplate):
         self.task_update_num = 5
         self.train_lr = 0.01 #this is the inner loop learning rate
         self.approx = approx #first order approx.    
+        self.batch_tasks = batch_tasks #adapt the n_task tasks of a meta-batch at once, fast weights stacked along a leading task dimension
+        self.second_order_steps = second_order_steps #backpropagate second order terms through only the last second_order_steps inner steps, None for all
+        self.first_order_epochs = first_order_epochs #first order adaptation for the epochs before, the cheap start of a first to second order schedule
         self.inner_loop_steps_list  = []  
+        self.current_epoch = 0
 
 
 
+    def set_epoch(self, epoch):
+        self.current_epoch = epoch
+
     def forward(self,x):
         out  = self.feature.forward(x)
         scores  = self.classifier.forward(out)
@@ -34,23 +42,26 @@ class MAML(MetaTemplate):
     def set_forward(self,x, is_feature = False):
         assert is_feature == False, 'MAML do not support fixed feature' 
         
-        x = x.cuda()
+        x = x.to(self.device)
         x_var = Variable(x)
         x_a_i = x_var[:,:self.n_support,:,:,:].contiguous().view( self.n_way* self.n_support, *x.size()[2:]) #support data 
         x_b_i = x_var[:,self.n_support:,:,:,:].contiguous().view( self.n_way* self.n_query,   *x.size()[2:]) #query data
-        y_a_i = Variable( torch.from_numpy( np.repeat(range( self.n_way ), self.n_support ) )).cuda() #label for support data
+        y_a_i = self.get_label(self.n_support) #label for support data
         
         fast_parameters = list(self.parameters()) #the first gradient calcuated in line 45 is based on original weight
         for weight in self.parameters():
             weight.fast = None
         self.zero_grad()
 
-
+        prof = self.profiler
         for task_step in range(self.task_update_num): 
+            if prof is not None:
+                t = prof.tic()
             scores = self.forward(x_a_i)
             set_loss = self.loss_fn( scores, y_a_i) 
-            grad = torch.autograd.grad(set_loss, fast_parameters, create_graph=True) #build full graph support gradient of gradient
-            if self.approx:
+            create_graph = self.create_graph(task_step)
+            grad = torch.autograd.grad(set_loss, fast_parameters, create_graph=create_graph) #build full graph support gradient of gradient
+            if not create_graph:
                 grad = [ g.detach()  for g in grad ] #do not calculate gradient of gradient if using first order approximation
             fast_parameters = []
             for k, weight in enumerate(self.parameters()):
@@ -60,6 +71,8 @@ class MAML(MetaTemplate):
                 else:
                     weight.fast = weight.fast - self.train_lr * grad[k] #create an updated weight.fast, note the '-' is not merely minus value, but to create a new weight.fast 
                 fast_parameters.append(weight.fast) #gradients calculated in line 45 are based on newest fast weight, but the graph will retain the link to old weight.fasts
+            if prof is not None:
+                prof.inner_step(task_step, prof.tic() - t)
 
 
         # feed forward query data
@@ -72,42 +85,65 @@ class MAML(MetaTemplate):
 
     def set_forward_loss(self, x):
         scores = self.set_forward(x, is_feature = False)
-        y_b_i = Variable( torch.from_numpy( np.repeat(range( self.n_way ), self.n_query   ) )).cuda()
+        y_b_i = self.get_label(self.n_query)
         loss = self.loss_fn(scores, y_b_i)
 
         return loss
 
-
     def train_loop(self, epoch, train_loader, optimizer): #overwrite parrent function
         print_freq = 10
         avg_loss=0
         task_count = 0
         loss_all = []
+        x_all = []
+
+        self.set_epoch(epoch)
 
         optimizer.zero_grad()
+        prof = self.profiler
+        if prof is not None:
+            t = prof.tic()
 
         #train
         for i, (x,_) in enumerate(train_loader):
+            if prof is not None:
+                t = prof.lap('data', t)
 
             self.n_query = x.size(1) - self.n_support
             assert self.n_way  ==  x.size(0), "MAML do not support way change"
             
 
-            loss = self.set_forward_loss(x)
-            avg_loss = avg_loss+loss.item()
-            loss_all.append(loss)
+            if self.batch_tasks:
+                x_all.append(x)
+            else:
+                loss = self.set_forward_loss(x)
+                avg_loss = avg_loss+loss.item()
+                loss_all.append(loss)
+                if prof is not None:
+                    t = prof.lap('inner_loop', t)
 
             task_count += 1
 
             if task_count == self.n_task: #MAML update several tasks at one time
        
-                loss_q = torch.stack(loss_all).sum(0)
+                if self.batch_tasks:
+                    loss_q = self.set_forward_loss_batch(torch.stack(x_all))
+                    avg_loss = avg_loss+loss_q.item()
+                    if prof is not None:
+                        t = prof.lap('inner_loop', t)
+                else:
+                    loss_q = torch.stack(loss_all).sum(0)
                 loss_value = loss_q.item()
                 loss_q.backward()
+                if prof is not None:
+                    t = prof.lap('outer_backward', t)
                 optimizer.step()
+                if prof is not None:
+                    t = prof.lap('optimizer', t)
     
                 task_count = 0
                 loss_all = []
+                x_all = []
             optimizer.zero_grad()
             if i % print_freq==0:
                 print('Epoch {:d} | Batch {:d}/{:d} | Loss {:f}'.format(epoch, i, len(train_loader), avg_loss/float(i+1)))
@@ -119,13 +155,23 @@ class MAML(MetaTemplate):
         acc_all = []
         
         iter_num = len(test_loader) 
+        prof = self.profiler
+        if prof is not None:
+            prof.prefix = 'test_'
+            t = prof.tic()
         # for i, (x,_) in enumerate(test_loader):
         for i, (x,_) in enumerate(tqdm(test_loader, desc='Testing', leave=False)):
+            if prof is not None:
+                t = prof.lap('data', t)
             self.n_query = x.size(1) - self.n_support
             assert self.n_way  ==  x.size(0), "MAML do not support way change"
             correct_this, count_this, loss = self.correct(x)
             acc_all.append(correct_this/ count_this *100 )
             avg_loss = avg_loss+loss.item()
+            if prof is not None:
+                t = prof.lap('inner_loop', t)
+        if prof is not None:
+            prof.prefix = ''
 
         acc_all  = np.asarray(acc_all)
         acc_mean = np.mean(acc_all)
@@ -51,31 +51,44 @@ class MatchingNet(MetaTemplate):
         z_query     = z_query.contiguous().view( self.n_way* self.n_query, -1 )
         G, G_normalized = self.encode_training_set( z_support)
 
-        y_s         = torch.from_numpy(np.repeat(range( self.n_way ), self.n_support ))
-        Y_S         = Variable( utils.one_hot(y_s, self.n_way ) ).cuda()
+        y_s         = self.get_label(self.n_support)
+        Y_S         = utils.one_hot(y_s, self.n_way )
         f           = z_query
         logprobs = self.get_logprobs(f, G, G_normalized, Y_S)
         return logprobs
 
+    def set_forward_batch(self, x, is_feature = False): #x: [n_task, n_way, n_support + n_query, ...], logprobs of all tasks at once: [n_task, n_way* n_query, n_way]
+        z_support, z_query  = self.parse_feature_batch(x,is_feature)
+        n_task = z_support.size(0)
+
+        S           = z_support.contiguous().view( n_task, self.n_way* self.n_support, -1 )
+        f           = z_query.contiguous().view( n_task, self.n_way* self.n_query, -1 )
+        out_G = self.G_encoder(S)[0] #the LSTM is batch first, every task is one sequence
+        G = S + out_G[:,:,:S.size(2)] + out_G[:,:,S.size(2):]
+        G_normalized = G.div(torch.norm(G,p=2, dim =2, keepdim = True)+ 0.00001) 
+
+        y_s         = self.get_label(self.n_support)
+        Y_S         = utils.one_hot(y_s, self.n_way )
+        F = self.FCE.forward_batch(f, G)
+        F_normalized = F.div(torch.norm(F,p=2, dim =2, keepdim = True)+ 0.00001) 
+        scores = self.relu( F_normalized.bmm(G_normalized.transpose(1,2))  ) *100
+        softmax = torch.softmax(scores, dim = 2)
+        logprobs =(softmax.matmul(Y_S)+1e-6).log()
+        return logprobs
+
     def set_forward_loss(self, x):
-        y_query = torch.from_numpy(np.repeat(range( self.n_way ), self.n_query ))
-        y_query = Variable(y_query.cuda())
+        y_query = self.get_label(self.n_query)
 
         logprobs = self.set_forward(x)
 
         return self.loss_fn(logprobs, y_query )
 
-    def cuda(self):
-        super(MatchingNet, self).cuda()
-        self.FCE = self.FCE.cuda()
-        return self
-
 class FullyContextualEmbedding(nn.Module):
     def __init__(self, feat_dim):
         super(FullyContextualEmbedding, self).__init__()
         self.lstmcell = nn.LSTMCell(feat_dim*2, feat_dim)
         self.softmax = nn.Softmax(dim=1)
-        self.c_0 = Variable(torch.zeros(1,feat_dim))
+        self.register_buffer('c_0', torch.zeros(1,feat_dim), persistent = False) #a buffer follows model.to(device), non-persistent to keep checkpoint keys unchanged
         self.feat_dim = feat_dim
         #self.K = K
 
@@ -94,8 +107,22 @@ class FullyContextualEmbedding(nn.Module):
             h = h + f
 
         return h
-    def cuda(self):
-        super(FullyContextualEmbedding, self).cuda()
-        self.c_0 = self.c_0.cuda()
-        return self
+
+    def forward_batch(self, f, G): #forward of n_task tasks at once, f: [n_task, n_query, feat_dim], G: [n_task, n_support, feat_dim]
+        n_task, n_query = f.size(0), f.size(1)
+        f = f.reshape(n_task* n_query, -1)
+        h = f
+        c = self.c_0.expand_as(f)
+        G_T = G.transpose(1,2)
+        K = G.size(1)
+        for k in range(K):
+            logit_a = h.view(n_task, n_query, -1).bmm(G_T)
+            a = torch.softmax(logit_a, dim = 2)
+            r = a.bmm(G).view(n_task* n_query, -1)
+            x = torch.cat((f, r),1)
+
+            h, c = self.lstmcell(x, (h, c))
+            h = h + f
+
+        return h.view(n_task, n_query, -1)
 
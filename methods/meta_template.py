@@ -17,6 +17,19 @@ class MetaTemplate(nn.Module):
         self.feature    = model_func()
         self.feat_dim   = self.feature.final_feat_dim
         self.change_way = change_way  #some methods allow different_way classification during training and test
+        self.label_cache = {} #episode labels only depend on the episode shape, keep one tensor per shape and device
+        self.profiler   = None #profiling.Profiler timing the train/test loops, None to disable
+
+    @property
+    def device(self):
+        return next(self.parameters()).device #follows model.to(device)
+
+    def get_label(self, n_per_class, n_task = 1):
+        #np.repeat(range(n_way), n_per_class) on the model device, repeated for n_task tasks
+        key = (self.n_way, n_per_class, n_task, self.device)
+        if key not in self.label_cache:
+            self.label_cache[key] = torch.from_numpy(np.repeat(range( self.n_way ), n_per_class )).repeat(n_task).to(self.device)
+        return self.label_cache[key]
 
     @abstractmethod
     def set_forward(self,x,is_feature):
@@ -31,7 +44,7 @@ class MetaTemplate(nn.Module):
         return out
 
     def parse_feature(self,x,is_feature):
-        x    = Variable(x.cuda())
+        x    = Variable(x.to(self.device))
         if is_feature:
             z_all = x
         else:
@@ -43,14 +56,25 @@ class MetaTemplate(nn.Module):
 
         return z_support, z_query
 
+    def parse_feature_batch(self,x,is_feature): #parse_feature of n_task stacked episodes, x: [n_task, n_way, n_support + n_query, ...]
+        x    = x.to(self.device)
+        if is_feature:
+            z_all = x
+        else:
+            z_all = self.feature.forward(x.contiguous().view( -1, *x.size()[3:]))
+            z_all = z_all.view( *x.size()[:3], -1)
+        z_support   = z_all[:, :, :self.n_support]
+        z_query     = z_all[:, :, self.n_support:]
+
+        return z_support, z_query
+
     def correct(self, x):       
         scores = self.set_forward(x)
-        y = torch.from_numpy(np.repeat(range(self.n_way), self.n_query))
+        y = self.get_label(self.n_query)
         
         if hasattr(self, 'loss_type') and self.loss_type == 'mse':
             y = utils.one_hot(y, self.n_way)
             
-        y = Variable(y.cuda())
         loss = self.loss_fn(scores, y)
 
         y_query = np.repeat(range( self.n_way ), self.n_query )
@@ -63,44 +87,67 @@ class MetaTemplate(nn.Module):
     def train_loop(self, epoch, train_loader, optimizer):
         print_freq = 10
         avg_loss=0
+        prof = self.profiler
+        if prof is not None:
+            t = prof.tic()
 
         for i, (x,_ ) in enumerate(train_loader):
+            if prof is not None:
+                t = prof.lap('data', t)
             self.n_query = x.size(1) - self.n_support           
             if self.change_way:
                 self.n_way  = x.size(0)
             optimizer.zero_grad()
             loss = self.set_forward_loss( x )
+            if prof is not None:
+                t = prof.lap('inner_loop', t)
             loss.backward()
+            if prof is not None:
+                t = prof.lap('outer_backward', t)
             optimizer.step()
+            if prof is not None:
+                t = prof.lap('optimizer', t)
             avg_loss = avg_loss+loss.item()
 
             if i % print_freq==0:
                 #print(optimizer.state_dict()['param_groups'][0]['lr'])
                 print('Epoch {:d} | Batch {:d}/{:d} | Loss {:f}'.format(epoch, i, len(train_loader), avg_loss/float(i+1)))
 
-    def test_loop(self, test_loader):
+    def test_loop(self, test_loader, return_std = False):
         correct =0
         count = 0
         avg_loss=0
         acc_all = []
         
         iter_num = len(test_loader) 
+        prof = self.profiler
+        if prof is not None:
+            prof.prefix = 'test_'
+            t = prof.tic()
 
         for i, (x,_) in enumerate(tqdm(test_loader, desc='Testing', leave=False)):
         # for i, (x,_) in enumerate(test_loader):
+            if prof is not None:
+                t = prof.lap('data', t)
             self.n_query = x.size(1) - self.n_support
             if self.change_way:
                 self.n_way  = x.size(0)
             correct_this, count_this, loss = self.correct(x)
             acc_all.append(correct_this/ count_this*100  )
             avg_loss = avg_loss+loss.item()
+            if prof is not None:
+                t = prof.lap('inner_loop', t)
+        if prof is not None:
+            prof.prefix = ''
 
         acc_all  = np.asarray(acc_all)
         acc_mean = np.mean(acc_all)
         acc_std  = np.std(acc_all)
         print('%d Test Acc = %4.2f%% ± %4.2f%%, Test Loss = %4.4f' %(iter_num,  acc_mean, 1.96* acc_std/np.sqrt(iter_num), float(avg_loss/iter_num)))
-
-        return acc_mean, float(avg_loss/iter_num)
+        if return_std:
+            return acc_mean, acc_std, float(avg_loss/iter_num)
+        else:
+            return acc_mean, float(avg_loss/iter_num)
 
     def set_forward_adaptation(self, x, is_feature = True): #further adaptation, default is fixing feature and train a new softmax clasifier
         assert is_feature == True, 'Feature is fixed in further adaptation'
@@ -109,16 +156,14 @@ class MetaTemplate(nn.Module):
         z_support   = z_support.contiguous().view(self.n_way* self.n_support, -1 )
         z_query     = z_query.contiguous().view(self.n_way* self.n_query, -1 )
 
-        y_support = torch.from_numpy(np.repeat(range( self.n_way ), self.n_support ))
-        y_support = Variable(y_support.cuda())
+        y_support = self.get_label(self.n_support)
 
         linear_clf = nn.Linear(self.feat_dim, self.n_way)
-        linear_clf = linear_clf.cuda()
+        linear_clf = linear_clf.to(self.device)
 
         set_optimizer = torch.optim.SGD(linear_clf.parameters(), lr = 0.01, momentum=0.9, dampening=0.9, weight_decay=0.001)
 
         loss_function = nn.CrossEntropyLoss()
-        loss_function = loss_function.cuda()
         
         batch_size = 4
         support_size = self.n_way* self.n_support
@@ -126,7 +171,7 @@ class MetaTemplate(nn.Module):
             rand_id = np.random.permutation(support_size)
             for i in range(0, support_size , batch_size):
                 set_optimizer.zero_grad()
-                selected_id = torch.from_numpy( rand_id[i: min(i+batch_size, support_size) ]).cuda()
+                selected_id = torch.from_numpy( rand_id[i: min(i+batch_size, support_size) ]).to(self.device)
                 z_batch = z_support[selected_id]
                 y_batch = y_support[selected_id] 
                 scores = linear_clf(z_batch)
@@ -25,10 +25,21 @@ class ProtoNet(MetaTemplate):
         scores = -dists
         return scores
 
+    def set_forward_batch(self,x,is_feature = False): #x: [n_task, n_way, n_support + n_query, ...], scores of all tasks at once: [n_task, n_way* n_query, n_way]
+        z_support, z_query  = self.parse_feature_batch(x,is_feature)
+        n_task = z_support.size(0)
+
+        z_proto     = z_support.mean(2) 
+        z_query     = z_query.contiguous().view(n_task, self.n_way* self.n_query, -1 )
+
+        #|q - p|^2 = |q|^2 - 2 q.p + |p|^2 with one bmm, euclidean_dist would materialize a [n_task, n_query, n_way, dim] difference
+        dists = torch.baddbmm(z_proto.pow(2).sum(2).unsqueeze(1), z_query, z_proto.transpose(1,2), alpha = -2) + z_query.pow(2).sum(2, keepdim = True)
+        scores = -dists
+        return scores
+
 
     def set_forward_loss(self, x):
-        y_query = torch.from_numpy(np.repeat(range( self.n_way ), self.n_query ))
-        y_query = Variable(y_query.cuda())
+        y_query = self.get_label(self.n_query)
 
         scores = self.set_forward(x)
 
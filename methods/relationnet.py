@@ -29,13 +29,7 @@ class RelationNet(MetaTemplate):
         z_query     = z_query.contiguous().view( self.n_way* self.n_query, *self.feat_dim )
 
         
-        z_proto_ext = z_proto.unsqueeze(0).repeat(self.n_query* self.n_way,1,1,1,1)
-        z_query_ext = z_query.unsqueeze(0).repeat( self.n_way,1,1,1,1)
-        z_query_ext = torch.transpose(z_query_ext,0,1)
-        extend_final_feat_dim = self.feat_dim.copy()
-        extend_final_feat_dim[0] *= 2
-        relation_pairs = torch.cat((z_proto_ext,z_query_ext),2).view(-1, *extend_final_feat_dim)
-        relations = self.relation_module(relation_pairs).view(-1, self.n_way)
+        relations = self.relation_module.forward_pairs(z_proto, z_query) #[n_way* n_query, n_way], pairs are never concatenated
 
         return relations
 
@@ -58,19 +52,17 @@ class RelationNet(MetaTemplate):
         for epoch in range(100):
             perm_id = np.random.permutation(full_n_support).tolist()            
             sub_x = np.array([z_support_cpu[i,perm_id,:,:,:] for i in range(z_support.size(0))])
-            sub_x = torch.Tensor(sub_x).cuda()
+            sub_x = torch.Tensor(sub_x).to(self.device)
             if self.change_way:
                 self.n_way  = sub_x.size(0)
             set_optimizer.zero_grad()
-            y = torch.from_numpy(np.repeat(range( self.n_way ), self.n_query ))
+            y = self.get_label(self.n_query)
             scores = self.set_forward(sub_x, is_feature = True)
             if self.loss_type == 'mse':
                 y_oh = utils.one_hot(y, self.n_way)
-                y_oh = Variable(y_oh.cuda())            
 
                 loss =  self.loss_fn(scores, y_oh )
             else:
-                y = Variable(y.cuda())
                 loss = self.loss_fn(scores, y )
             loss.backward()
             set_optimizer.step()
@@ -81,27 +73,18 @@ class RelationNet(MetaTemplate):
         z_query     = z_query.contiguous().view( self.n_way* self.n_query, *self.feat_dim )
 
         
-        z_proto_ext = z_proto.unsqueeze(0).repeat(self.n_query* self.n_way,1,1,1,1)
-        z_query_ext = z_query.unsqueeze(0).repeat( self.n_way,1,1,1,1)
-        z_query_ext = torch.transpose(z_query_ext,0,1)
-        extend_final_feat_dim = self.feat_dim.copy()
-        extend_final_feat_dim[0] *= 2
-        relation_pairs = torch.cat((z_proto_ext,z_query_ext),2).view(-1, *extend_final_feat_dim)
-        relations = self.relation_module(relation_pairs).view(-1, self.n_way)
+        relations = self.relation_module.forward_pairs(z_proto, z_query) #[n_way* n_query, n_way], pairs are never concatenated
 
         self.relation_module.load_state_dict(relation_module_clone.state_dict())
         return relations
     def set_forward_loss(self, x):
-        y = torch.from_numpy(np.repeat(range( self.n_way ), self.n_query ))
-
         scores = self.set_forward(x)
+        y = self.get_label(self.n_query)
         if self.loss_type == 'mse':
             y_oh = utils.one_hot(y, self.n_way)
-            y_oh = Variable(y_oh.cuda())            
 
             return self.loss_fn(scores, y_oh )
         else:
-            y = Variable(y.cuda())
             return self.loss_fn(scores, y )
 
 class RelationConvBlock(nn.Module):
@@ -141,8 +124,24 @@ class RelationModule(nn.Module):
         self.fc1 = nn.Linear( input_size[0]* shrink_s(input_size[1]) * shrink_s(input_size[2]), hidden_size )
         self.fc2 = nn.Linear( hidden_size,1)
 
-    def forward(self,x):
+    def forward(self,x): #x: concatenated [proto, query] pairs, [n_pairs, 2* dim, w, h]
         out = self.layer1(x)
+        return self.forward_rest(out)
+
+    def forward_pairs(self, z_proto, z_query):
+        #relations of every (query, prototype) pair, [n_query, n_proto], as forward on the concatenated pairs.
+        #The first conv is linear, so it is split into its prototype and query input channels: each half runs once per
+        #prototype and once per query and the results are added by broadcasting, instead of convolving n_query* n_proto
+        #concatenated copies of the feature maps
+        conv = self.layer1.C
+        dim = z_proto.size(1)
+        out_proto = F.conv2d(z_proto, conv.weight[:, :dim], None, conv.stride, conv.padding)
+        out_query = F.conv2d(z_query, conv.weight[:, dim:], conv.bias, conv.stride, conv.padding)
+        out = (out_query.unsqueeze(1) + out_proto.unsqueeze(0)).flatten(0, 1) #pair q* n_proto + p, the order of the concatenated pairs
+        out = self.layer1.trunk[1:](out) #BN, ReLU, pooling of layer1
+        return self.forward_rest(out).view(z_query.size(0), z_proto.size(0))
+
+    def forward_rest(self, out): #everything after layer1
         out = self.layer2(out)
         out = out.view(out.size(0),-1)
         out = F.relu(self.fc1(out))
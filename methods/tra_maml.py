@@ -7,13 +7,14 @@ from torch.autograd import Variable
 import numpy as np
 import torch.nn.functional as F
 from methods.meta_template import MetaTemplate
-from methods.trapezoidal_step_scheduler import tra
+from methods.batched_inner_loop import BatchedInnerLoop
+from methods.trapezoidal_step_scheduler import TRASchedule
 from tqdm import tqdm
 
 
 
-class TRA_MAML(MetaTemplate):
-    def __init__(self, model_func,  n_way, n_support, min_step = None, max_step = None, width = None, test_mode = False, approx = False):
+class TRA_MAML(BatchedInnerLoop, MetaTemplate):
+    def __init__(self, model_func,  n_way, n_support, min_step = None, max_step = None, width = None, test_mode = False, approx = False, batch_tasks = False, total_epochs = 200, second_order_steps = None, first_order_epochs = 0):
         super(TRA_MAML, self).__init__( model_func,  n_way, n_support, change_way = False)
 
         self.loss_fn = nn.CrossEntropyLoss()
@@ -24,6 +25,9 @@ class TRA_MAML(MetaTemplate):
         self.task_update_num = 0
         self.train_lr = 0.01 #this is the inner loop learning rate
         self.approx = approx #first order approx.    
+        self.batch_tasks = batch_tasks #adapt the n_task tasks of a meta-batch at once, fast weights stacked along a leading task dimension
+        self.second_order_steps = second_order_steps #backpropagate second order terms through only the last second_order_steps inner steps, None for all
+        self.first_order_epochs = first_order_epochs #first order adaptation for the epochs before, the cheap start of a first to second order schedule
         self.inner_loop_steps_list  = []  
 
         # annealing parameters
@@ -32,53 +36,79 @@ class TRA_MAML(MetaTemplate):
         self.min_step = min_step
         self.max_step = max_step
         self.current_epoch = 0
+        self.total_epochs = total_epochs #length of the trapezoid, the stop_epoch of training
+        self.schedule = TRASchedule(total_epochs, min_step, max_step, width) #schedule[epoch] is the task_update_num of that epoch
+        self.budget = None #BudgetedTRA that reshapes the trapezoid to a compute budget, None for the plain schedule
         self.last_task_update_num = self.max_step
 
         self.test_mode = test_mode
+        self.test_steps = None #inner steps in test_mode, None for max_step. Set by test.py --adaptation
       
     def forward(self,x):
         out  = self.feature.forward(x)
         scores  = self.classifier.forward(out)
         return scores
 
-    def annealing_func(self, min_step, max_step, width, current_epoch):
-      return tra(total_epochs = 200, current_epoch = current_epoch, max_step = max_step, min_step = min_step, max_step_width = width)
+    def annealing_func(self, current_epoch):
+      if self.budget is not None:
+          return self.budget.steps(current_epoch)
+      return self.schedule[current_epoch]
 
 
     def set_epoch(self, epoch):
         self.current_epoch = epoch
 
+    def train_state(self):
+        #schedule state for --resume, not part of state_dict() so checkpoints stay loadable for testing
+        state = dict(current_epoch = self.current_epoch, last_task_update_num = self.last_task_update_num)
+        if self.budget is not None:
+            state['budget'] = self.budget.state_dict()
+        return state
+
+    def load_train_state(self, state):
+        self.current_epoch = state['current_epoch']
+        self.last_task_update_num = state['last_task_update_num']
+        if self.budget is not None and 'budget' in state:
+            self.budget.load_state_dict(state['budget'])
+
+    def set_task_update_num(self):
+        # do not anneal the inner steps in meta testing
+        if self.test_mode:
+            self.task_update_num = self.max_step if self.test_steps is None else self.test_steps # use full GD steps for testing
+        else:
+            # Calculate task_update_num based on current epoch
+            self.task_update_num = self.annealing_func(self.current_epoch)
+
+        # Print task_update_num if it has changed
+        if self.task_update_num != int(self.last_task_update_num):
+            print(f"task_update_num has changed to: {self.task_update_num}")
+            self.last_task_update_num = self.task_update_num
+
     def set_forward(self,x, is_feature = False):
         assert is_feature == False, 'TRA_MAML do not support fixed feature' 
         
-        x = x.cuda()
+        x = x.to(self.device)
         x_var = Variable(x)
         x_a_i = x_var[:,:self.n_support,:,:,:].contiguous().view( self.n_way* self.n_support, *x.size()[2:]) #support data 
         x_b_i = x_var[:,self.n_support:,:,:,:].contiguous().view( self.n_way* self.n_query,   *x.size()[2:]) #query data
-        y_a_i = Variable( torch.from_numpy( np.repeat(range( self.n_way ), self.n_support ) )).cuda() #label for support data
+        y_a_i = self.get_label(self.n_support) #label for support data
         
         fast_parameters = list(self.parameters()) #the first gradient calcuated in line 45 is based on original weight
         for weight in self.parameters():
             weight.fast = None
         self.zero_grad()
 
-        # do not anneal the inner steps in meta testing
-        if self.test_mode:
-            self.task_update_num = self.max_step # use full GD steps for testing
-        else:
-            # Calculate task_update_num based on current epoch
-            self.task_update_num = self.annealing_func(self.min_step, self.max_step, self.width, self.current_epoch)
-
-        # Print task_update_num if it has changed
-        if self.task_update_num != int(self.last_task_update_num):
-            print(f"task_update_num has changed to: {self.task_update_num}")
-            self.last_task_update_num = self.task_update_num
+        self.set_task_update_num()
 
+        prof = self.profiler
         for task_step in range(self.task_update_num): 
+            if prof is not None:
+                t = prof.tic()
             scores = self.forward(x_a_i)
             set_loss = self.loss_fn( scores, y_a_i) 
-            grad = torch.autograd.grad(set_loss, fast_parameters, create_graph=True) #build full graph support gradient of gradient
-            if self.approx:
+            create_graph = self.create_graph(task_step)
+            grad = torch.autograd.grad(set_loss, fast_parameters, create_graph=create_graph) #build full graph support gradient of gradient
+            if not create_graph:
                 grad = [ g.detach()  for g in grad ] #do not calculate gradient of gradient if using first order approximation
             fast_parameters = []
             for k, weight in enumerate(self.parameters()):
@@ -88,6 +118,8 @@ class TRA_MAML(MetaTemplate):
                 else:
                     weight.fast = weight.fast - self.train_lr * grad[k] #create an updated weight.fast, note the '-' is not merely minus value, but to create a new weight.fast 
                 fast_parameters.append(weight.fast) #gradients calculated in line 45 are based on newest fast weight, but the graph will retain the link to old weight.fasts
+            if prof is not None:
+                prof.inner_step(task_step, prof.tic() - t)
 
 
         # feed forward query data
@@ -100,44 +132,65 @@ class TRA_MAML(MetaTemplate):
 
     def set_forward_loss(self, x):
         scores = self.set_forward(x, is_feature = False)
-        y_b_i = Variable( torch.from_numpy( np.repeat(range( self.n_way ), self.n_query   ) )).cuda()
+        y_b_i = self.get_label(self.n_query)
         loss = self.loss_fn(scores, y_b_i)
 
         return loss
 
-
     def train_loop(self, epoch, train_loader, optimizer): #overwrite parrent function
         print_freq = 10
         avg_loss=0
         task_count = 0
         loss_all = []
+        x_all = []
 
         self.set_epoch(epoch)
 
         optimizer.zero_grad()
+        prof = self.profiler
+        if prof is not None:
+            t = prof.tic()
 
         #train
         for i, (x,_) in enumerate(train_loader):
+            if prof is not None:
+                t = prof.lap('data', t)
 
             self.n_query = x.size(1) - self.n_support
             assert self.n_way  ==  x.size(0), "TRA_MAML do not support way change"
             
 
-            loss = self.set_forward_loss(x)
-            avg_loss = avg_loss+loss.item()
-            loss_all.append(loss)
+            if self.batch_tasks:
+                x_all.append(x)
+            else:
+                loss = self.set_forward_loss(x)
+                avg_loss = avg_loss+loss.item()
+                loss_all.append(loss)
+                if prof is not None:
+                    t = prof.lap('inner_loop', t)
 
             task_count += 1
 
             if task_count == self.n_task: #TRA_MAML update several tasks at one time
        
-                loss_q = torch.stack(loss_all).sum(0)
+                if self.batch_tasks:
+                    loss_q = self.set_forward_loss_batch(torch.stack(x_all))
+                    avg_loss = avg_loss+loss_q.item()
+                    if prof is not None:
+                        t = prof.lap('inner_loop', t)
+                else:
+                    loss_q = torch.stack(loss_all).sum(0)
                 loss_value = loss_q.item()
                 loss_q.backward()
+                if prof is not None:
+                    t = prof.lap('outer_backward', t)
                 optimizer.step()
+                if prof is not None:
+                    t = prof.lap('optimizer', t)
     
                 task_count = 0
                 loss_all = []
+                x_all = []
             optimizer.zero_grad()
             if i % print_freq==0:
                 print('Epoch {:d} | Batch {:d}/{:d} | Loss {:f}'.format(epoch, i, len(train_loader), avg_loss/float(i+1)))
@@ -150,13 +203,23 @@ class TRA_MAML(MetaTemplate):
         acc_all = []
         
         iter_num = len(test_loader) 
+        prof = self.profiler
+        if prof is not None:
+            prof.prefix = 'test_'
+            t = prof.tic()
 
         for i, (x,_) in enumerate(tqdm(test_loader, desc='Testing', leave=False)):
+            if prof is not None:
+                t = prof.lap('data', t)
             self.n_query = x.size(1) - self.n_support
             assert self.n_way  ==  x.size(0), "MAML do not support way change"
             correct_this, count_this, loss = self.correct(x)
             acc_all.append(correct_this/ count_this *100 )
             avg_loss = avg_loss+loss.item()
+            if prof is not None:
+                t = prof.lap('inner_loop', t)
+        if prof is not None:
+            prof.prefix = ''
 
         acc_all  = np.asarray(acc_all)
         acc_mean = np.mean(acc_all)
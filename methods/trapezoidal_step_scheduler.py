@@ -1,7 +1,9 @@
 import math
+import numpy as np
 
-    
-def tra(total_epochs, current_epoch, max_step, min_step, max_step_width):
+
+def tra_steps(epochs, total_epochs, max_step, min_step, max_step_width):
+    # Inner step count of the trapezoid at every epoch of the numpy array epochs
     step_diff = 0
     # Calculate the midpoint of total_epochs and max_step_width
     epoch_midpoint = total_epochs // 2
@@ -18,7 +20,7 @@ def tra(total_epochs, current_epoch, max_step, min_step, max_step_width):
 
     # Calculate the size of half step frequency and the frequency of step
     half_step_freq_size = total_step_freq_size // 2
-    step_freq = math.floor(half_step_freq_size / (max_step - 1))
+    step_freq = math.floor(half_step_freq_size / max(max_step - 1, 1)) #0 for short runs: then the plateau covers every epoch
 
     # Calculate the total step frequency and adjust max step size if necessary
     total_step_freq = (max_step - 1) * step_freq * 2
@@ -29,21 +31,114 @@ def tra(total_epochs, current_epoch, max_step, min_step, max_step_width):
     # Calculate the new half step frequency size
     new_half_step_freq_size = total_step_freq // 2
 
+    # Determine the current step based on the current epoch: ramp up, plateau, ramp down
     if max_step_width == 0 and step_diff > 0:
-         # Determine the current step based on the current epoch
-        if current_epoch < new_half_step_freq_size:
-            current_step = min_step + current_epoch // step_freq
-        elif current_epoch < (new_half_step_freq_size + step_diff):
-            current_step = (max_step - 1)
-        else:
-            current_step = (max_step - 1) - (current_epoch - step_freq * (max_step - 1) - step_diff) // step_freq       
+        plateau_size, plateau_step = step_diff, max_step - 1
     else:
-        # Determine the current step based on the current epoch
-        if current_epoch < new_half_step_freq_size:
-            current_step = min_step + current_epoch // step_freq
-        elif current_epoch < (new_half_step_freq_size + max_step_size):
-            current_step = max_step
-        else:
-            current_step = (max_step - 1) - (current_epoch - step_freq * (max_step - 1) - max_step_size) // step_freq
-
-    return current_step
+        plateau_size, plateau_step = max_step_size, max_step
+    divisor = max(step_freq, 1) #np.where evaluates every branch, the ramps are unused when step_freq is 0
+    ramp_up = min_step + epochs // divisor
+    ramp_down = (max_step - 1) - (epochs - step_freq * (max_step - 1) - plateau_size) // divisor
+    return np.where(epochs < new_half_step_freq_size, ramp_up,
+                    np.where(epochs < new_half_step_freq_size + plateau_size, plateau_step, ramp_down))
+
+
+def tra(total_epochs, current_epoch, max_step, min_step, max_step_width):
+    return int(tra_steps(np.asarray(current_epoch), total_epochs, max_step, min_step, max_step_width))
+
+
+def tra_table(total_epochs, min_step, max_step, width):
+    # epoch -> inner steps of a whole run, computed once. Steps are clamped to [min_step, max_step]: the trapezoid
+    # assumes min_step 1 and would otherwise overshoot max_step on the way up and drop below min_step on the way down
+    if total_epochs < 1:
+        raise ValueError(f'TRA needs at least one epoch, got {total_epochs}')
+    if not 1 <= min_step <= max_step:
+        raise ValueError(f'TRA needs 1 <= min_step <= max_step, got {min_step}-{max_step}')
+    if not 0 <= width <= 1:
+        raise ValueError(f'TRA width is a fraction of the epochs, got {width}')
+    if max_step == min_step: #flat schedule
+        return np.full(total_epochs, min_step, dtype = np.int64)
+    table = tra_steps(np.arange(total_epochs), total_epochs, max_step, min_step, width)
+    return np.clip(table, min_step, max_step).astype(np.int64)
+
+
+class TRASchedule:
+    # TRA inner step counts of a run, table[epoch] is the task_update_num of that epoch. Epochs past the end of the
+    # table (a run resumed with a larger stop_epoch) keep the last value
+    def __init__(self, total_epochs, min_step, max_step, width):
+        self.table = tra_table(total_epochs, min_step, max_step, width)
+        self.steps = self.table.tolist() #python ints, indexing them is cheaper than indexing the array
+
+    def __getitem__(self, epoch):
+        return self.steps[min(epoch, len(self.steps) - 1)]
+
+    def __len__(self):
+        return len(self.table)
+
+    def describe(self):
+        #run-length form for the logs: "steps x epochs, ..."
+        change = np.flatnonzero(np.diff(self.table)) + 1
+        starts = np.concatenate(([0], change))
+        lengths = np.diff(np.concatenate((starts, [len(self.table)])))
+        return ', '.join( f'{self.table[s]} x{n}' for s, n in zip(starts, lengths) )
+
+
+class BudgetedTRA:
+    # TRA schedule fitted to a wall-clock budget for the whole run. The cost of an epoch (training and validation) is
+    # modelled as a + b * steps, fitted on the measured seconds of the finished epochs. Before every epoch the plateau
+    # (the max_step given to tra) is set to the largest value in [min_step, max_step] whose predicted cost over the
+    # remaining epochs up to total_epochs fits the remaining budget. Early stopping only ends the run sooner.
+    def __init__(self, budget_s, total_epochs, min_step, max_step, width):
+        self.budget_s = budget_s
+        self.total_epochs = total_epochs
+        self.min_step = min_step
+        self.max_step = max_step
+        self.width = width
+        self.schedules = { plateau: TRASchedule(total_epochs, min_step, plateau, width) for plateau in range(min_step, max_step + 1) }
+        self.plateau = max_step
+        self.predicted_s = None #predicted seconds of the remaining epochs at the last plan
+        self.history = [] #(steps, seconds) of every finished epoch
+
+    @property
+    def schedule(self):
+        return self.schedules[self.plateau]
+
+    def steps(self, epoch):
+        return self.schedule[epoch]
+
+    def record(self, steps, seconds):
+        self.history.append((steps, seconds))
+
+    def epoch_cost(self, steps):
+        #predicted seconds of an epoch at steps inner steps, steps may be an array
+        k, s = np.array(self.history, dtype = float).T
+        if len(np.unique(k)) >= 2:
+            b, a = np.polyfit(k, s, 1)
+            return max(a, 0.) + max(b, 0.) * steps
+        return s.mean() * steps / k.mean() #one step count measured so far: proportional to steps, an overestimate for more steps
+
+    def plan(self, epoch, spent_s):
+        #choose the plateau for the epochs from epoch on, spent_s seconds of the budget are used; returns the plateau
+        if not self.history: #nothing measured yet, the first epoch runs at the bottom of the ramp anyway
+            return self.plateau
+        remaining_s = self.budget_s - spent_s
+        for plateau in range(self.max_step, self.min_step - 1, -1):
+            self.predicted_s = float(self.epoch_cost(self.schedules[plateau].table[epoch:]).sum())
+            if self.predicted_s <= remaining_s:
+                break
+        self.plateau = plateau
+        return plateau
+
+    def state_dict(self):
+        return dict(plateau = self.plateau, predicted_s = self.predicted_s, history = list(self.history))
+
+    def load_state_dict(self, state):
+        self.plateau = state['plateau']
+        self.predicted_s = state['predicted_s']
+        self.history = [ tuple(h) for h in state['history'] ]
+
+    def exhausted(self, epoch, spent_s):
+        #True when the next epoch is predicted not to fit in what is left of the budget
+        if not self.history:
+            return spent_s >= self.budget_s
+        return spent_s + self.epoch_cost(self.steps(epoch)) > self.budget_s
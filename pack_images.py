@@ -0,0 +1,74 @@
+import numpy as np
+import json
+import os
+import time
+from functools import partial
+from PIL import Image
+import torch.multiprocessing as mp
+
+import configs
+from data.datamgr import TransformLoader
+from data.dataset import packed_file
+from io_utils import parse_args
+
+
+def load_resized(image_path, resize):
+    img = Image.open(image_path).convert('RGB')
+    return np.asarray(resize(img))
+
+def pack_images(data_file, image_size, num_workers, if_missing = False):
+    #write every image of a filelist json, resized like the 'none' transform, into one uint8 [n, size, size, 3] .npy array
+    #and an index json (the filelist plus the array file name) that PackedSimpleDataset / PackedSetDataset read
+    with open(data_file, 'r') as f:
+        meta = json.load(f)
+
+    resize = TransformLoader(image_size).parse_transform('Resize')
+    size = resize.size[0]
+    index_file = packed_file(data_file, size)
+    images_file = os.path.splitext(index_file)[0] + '.npy'
+    if if_missing and os.path.isfile(index_file) and os.path.isfile(images_file) and os.path.getmtime(index_file) >= os.path.getmtime(data_file):
+        print(f'Skip {data_file}: already packed into {images_file}')
+        return
+
+    n = len(meta['image_names'])
+    images = np.lib.format.open_memmap(images_file, mode = 'w+', dtype = np.uint8, shape = (n, size, size, 3))
+    start_time = time.time()
+    with mp.Pool(num_workers) as pool:
+        for i, img in enumerate(pool.imap(partial(load_resized, resize = resize), meta['image_names'], chunksize = 16)):
+            images[i] = img
+            if i % 500 == 0:
+                print('{:d}/{:d}'.format(i, n))
+    images.flush()
+    del images
+
+    meta['images_file'] = os.path.basename(images_file)
+    meta['image_size'] = size
+    with open(index_file, 'w') as f:
+        json.dump(meta, f)
+    print(f'Packed {n} images of {data_file} into {images_file} ({n*size*size*3/2**20:.1f} MB) in {time.time() - start_time:.1f} s')
+
+
+if __name__ == '__main__':
+    mp.set_start_method('spawn')
+    params = parse_args('pack_images')
+
+    if 'Conv' in params.model:
+      image_size = 84
+    else:
+      image_size = 224
+
+    if params.dataset == 'cross_IDC':
+        data_files = dict(base = configs.data_dir['BreaKHis_40x'] + 'base.json',
+                          val = configs.data_dir['BreaKHis_40x'] + 'val.json',
+                          novel = configs.data_dir['BCHI'] + 'novel.json')
+    elif params.dataset in ['BreaKHis_40x', 'ISIC', 'Smear']:
+        data_files = { split: configs.data_dir[params.dataset] + split + '.json' for split in ['base', 'val', 'novel'] }
+    else:
+        raise ValueError(f"Unsupported dataset: {params.dataset}")
+
+    splits = ['base', 'val', 'novel'] if params.split == 'all' else [params.split]
+    for split in splits:
+        if os.path.isfile(data_files[split]):
+            pack_images(data_files[split], image_size, params.num_workers, if_missing = params.if_missing)
+        else:
+            print(f'Skip {split}: {data_files[split]} does not exist')
@@ -0,0 +1,54 @@
+# Test episodes of maml / maml_approx / tra_maml evaluated on a pool of processes (test.py --test_workers N).
+# Every worker holds a replica of the model and runs --threads_per_worker torch threads. The episodes come from an
+# episode manifest (data/manifest.py) and each is evaluated on its own, so its accuracy does not depend on which worker
+# evaluates it or on how many workers there are. The accuracies are merged in episode order into the usual
+# mean ± 1.96*std/sqrt(n).
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+import backbone
+from data.dataset import EpisodeDataset
+
+worker = {} #state of a pool process, set by init_worker
+
+
+def init_worker(model, dataset, n_way, threads):
+    torch.set_num_threads(threads)
+    backbone.ConvBlock.maml = True
+    backbone.SimpleBlock.maml = True
+    backbone.BottleneckBlock.maml = True
+    backbone.ResNet.maml = True
+    worker['model'] = model.eval()
+    worker['episodes'] = EpisodeDataset(dataset, n_way)
+
+
+def evaluate_episode(task):
+    episode, ids = task
+    model = worker['model']
+    x, _ = worker['episodes'][ids]
+    model.n_query = x.size(1) - model.n_support
+    correct_this, count_this, loss = model.correct(x)
+    return episode, correct_this/ count_this *100, loss.item()
+
+
+def parallel_test(model, dataset, episode_ids, workers, threads = 1):
+    #dataset: flat dataset (SetDataManager.get_dataset), episode_ids: [iter_num, n_way, n_per_class] indices into it (EpisodeManifest.image_ids)
+    #returns acc_mean, acc_std, avg_loss like MAML.test_loop(return_std = True)
+    iter_num, n_way = episode_ids.shape[:2]
+    tasks = [ (i, ids.reshape(-1).tolist()) for i, ids in enumerate(episode_ids) ]
+
+    acc_all = np.empty(iter_num)
+    loss_all = np.empty(iter_num)
+    with mp.get_context('spawn').Pool(workers, initializer = init_worker, initargs = (model, dataset, n_way, threads)) as pool:
+        for i, acc, loss in tqdm(pool.imap_unordered(evaluate_episode, tasks), total = iter_num, desc = 'Testing', leave = False):
+            acc_all[i] = acc
+            loss_all[i] = loss
+
+    acc_mean = np.mean(acc_all)
+    acc_std  = np.std(acc_all)
+    avg_loss = float(np.mean(loss_all))
+    print('%d Test Acc = %4.2f%% ± %4.2f%%, Test Loss = %4.4f' %(iter_num,  acc_mean, 1.96* acc_std/np.sqrt(iter_num), avg_loss))
+    return acc_mean, acc_std, avg_loss
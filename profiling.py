@@ -0,0 +1,144 @@
+import resource
+import time
+import torch
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+aten = torch.ops.aten
+
+#ops that create a tensor from nothing, e.g. the torch.zeros/torch.ones running statistics BatchNorm2d_fw used to build on every call
+FACTORY_OPS = { aten.zeros, aten.ones, aten.empty, aten.full, aten.empty_strided, aten.scalar_tensor,
+                aten.zeros_like, aten.ones_like, aten.empty_like, aten.full_like,
+                aten.new_zeros, aten.new_ones, aten.new_empty, aten.new_full }
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+    #peak bytes since reset_peak_memory: from the CUDA caching allocator on GPU. On CPU the peak RSS of the process, which
+    #cannot be reset, so it only grows when a later epoch needs more than every earlier one
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #ru_maxrss is in KB on Linux
+
+
+class AllocationCounter(TorchDispatchMode):
+    #counts every tensor allocated by aten ops (forward and backward) while active:
+    #  with AllocationCounter() as counter:
+    #      ...
+    #  counter.stats() -> dict(tensors, bytes, factory, transfers)
+    def __init__(self):
+        super(AllocationCounter, self).__init__()
+        self.reset()
+
+    def reset(self):
+        self.tensors = 0 #output tensors that got fresh storage
+        self.bytes = 0
+        self.factory = 0 #tensors created from scratch by FACTORY_OPS
+        self.transfers = 0 #copies to another device (.cuda(), .to(device))
+
+    def stats(self):
+        return dict(tensors = self.tensors, bytes = self.bytes, factory = self.factory, transfers = self.transfers)
+
+    def __torch_dispatch__(self, func, types, args = (), kwargs = None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+
+        in_ptrs = set( t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor) )
+        for t in tree_flatten(out)[0]:
+            if not isinstance(t, torch.Tensor) or t.untyped_storage().data_ptr() in in_ptrs: #views and in-place results do not allocate
+                continue
+            self.tensors += 1
+            self.bytes += t.untyped_storage().nbytes()
+            if func.overloadpacket in FACTORY_OPS:
+                self.factory += 1
+            elif func.overloadpacket == aten._to_copy and kwargs.get('device') is not None:
+                self.transfers += 1
+        return out
+
+
+class Profiler:
+    #opt-in timers of the train/test loops, attach with model.profiler = Profiler(device). The loops only test
+    #`self.profiler is not None`, so nothing is timed or synchronized when no profiler is attached.
+    #  phases       data (waiting for the loader), inner_loop (set_forward_loss: the fast weight adaptation and query forward
+    #               for maml variants, the plain forward otherwise), outer_backward, optimizer; test_data and test_inner_loop in test_loop
+    #  inner steps  time of every inner step index of the maml variants, separately for training and testing
+    #  allocations  bytes allocated during the epoch and the peak, from the CUDA caching allocator on GPU,
+    #               from an AllocationCounter on CPU when count_allocations is set (slow, every aten op is intercepted)
+    def __init__(self, device, count_allocations = False):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.count_allocations = count_allocations
+        self.prefix = '' #'test_' inside test loops
+        self.counter = None
+        self.start_epoch(None)
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def tic(self):
+        self.sync()
+        return time.perf_counter()
+
+    def lap(self, phase, t):
+        #adds the time since t to phase, returns the new time stamp
+        now = self.tic()
+        self.add(self.prefix + phase, now - t)
+        return now
+
+    def add(self, phase, seconds):
+        total = self.phases.setdefault(phase, [0., 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def inner_step(self, step, seconds):
+        steps = self.inner_steps.setdefault(self.prefix + 'inner_steps', {})
+        total = steps.setdefault(step, [0., 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.phases = {}
+        self.inner_steps = {}
+        self.start_time = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.allocated_start = torch.cuda.memory_stats(self.device).get('allocated_bytes.all.allocated', 0)
+        elif self.count_allocations and epoch is not None:
+            self.counter = AllocationCounter()
+            self.counter.__enter__()
+
+    def end_epoch(self):
+        #summary of the epoch, json serializable
+        summary = dict(epoch = self.epoch, total_s = time.perf_counter() - self.start_time)
+        summary['phases'] = { phase: dict(total_s = total, count = count, mean_ms = 1000* total / count) for phase, (total, count) in self.phases.items() }
+        for name, steps in self.inner_steps.items():
+            summary[name] = { str(step): dict(mean_ms = 1000* total / count, count = count) for step, (total, count) in sorted(steps.items()) }
+        if self.cuda:
+            summary['allocated_bytes'] = torch.cuda.memory_stats(self.device).get('allocated_bytes.all.allocated', 0) - self.allocated_start
+            summary['peak_allocated_bytes'] = torch.cuda.max_memory_allocated(self.device)
+        elif self.counter is not None:
+            self.counter.__exit__(None, None, None)
+            summary['allocated_bytes'] = self.counter.bytes
+            summary['allocated_tensors'] = self.counter.tensors
+            self.counter = None
+        return summary
+
+    @staticmethod
+    def format(summary):
+        #one line for training_logs.txt
+        line = 'Epoch: %s, Profile: total %.1fs' %(summary['epoch'], summary['total_s'])
+        line += ''.join( ', %s %.1fs (%.1f ms x %d)' %(phase, p['total_s'], p['mean_ms'], p['count']) for phase, p in summary['phases'].items() )
+        for name in ['inner_steps', 'test_inner_steps']:
+            if name in summary:
+                line += ', %s ms %s' %(name, ' '.join( '[%s] %.1f' %(step, s['mean_ms']) for step, s in summary[name].items() ))
+        if 'allocated_bytes' in summary:
+            line += ', allocated %.1f MB' %(summary['allocated_bytes'] / 2**20)
+        if 'peak_allocated_bytes' in summary:
+            line += ', peak %.1f MB' %(summary['peak_allocated_bytes'] / 2**20)
+        return line
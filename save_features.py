@@ -3,7 +3,10 @@ import torch
 from torch.autograd import Variable
 import os
 import glob
+import json
 import h5py
+import queue
+import threading
 
 import configs
 import backbone
@@ -18,36 +21,105 @@ from methods.relationnet import RelationNet
 from io_utils import model_dict, parse_args, get_resume_file, get_best_file, get_assigned_file 
 import torch.multiprocessing as mp
 
-def save_features(model, data_loader, outfile ):
-    f = h5py.File(outfile, 'w')
-    max_count = len(data_loader)*data_loader.batch_size
-    all_labels = f.create_dataset('all_labels',(max_count,), dtype='i')
-    all_feats=None
-    count=0
-    for i, (x,y) in enumerate(data_loader):
-        if i%10 == 0:
-            print('{:d}/{:d}'.format(i, len(data_loader)))
-        x = x.cuda()
-        x_var = Variable(x)
-        feats = model(x_var)
-        if all_feats is None:
-            all_feats = f.create_dataset('all_feats', [max_count] + list( feats.size()[1:]) , dtype='f')
-        all_feats[count:count+feats.size(0)] = feats.data.cpu().numpy()
-        all_labels[count:count+feats.size(0)] = y.cpu().numpy()
-        count = count + feats.size(0)
-
-    count_var = f.create_dataset('count', (1,), dtype='i')
-    count_var[0] = count
-
-    f.close()
+class FeatureWriter:
+    #appends batches of features and labels to an hdf5 file from a background thread, so the next batch is computed
+    #while the previous one is written. Datasets are chunked (optionally compressed), grow by exactly the rows written,
+    #and keep the all_feats / all_labels / count layout read by data.feature_loader, plus all_ids, the filelist index of every row
+    def __init__(self, outfile, float16 = False, compression = 'lzf', chunk_bytes = 2**20, max_pending = 8):
+        self.outfile = outfile
+        self.f = h5py.File(outfile, 'w')
+        self.dtype = 'f2' if float16 else 'f4'
+        self.compression = None if compression == 'none' else compression
+        self.chunk_bytes = chunk_bytes
+        self.count = 0
+        self.all_feats = None
+        self.all_labels = self.f.create_dataset('all_labels', (0,), maxshape = (None,), chunks = (4096,), dtype = 'i', compression = self.compression)
+        self.all_ids = self.f.create_dataset('all_ids', (0,), maxshape = (None,), chunks = (4096,), dtype = 'i8', compression = self.compression)
+        self.pending = queue.Queue(max_pending) #bounds the batches held in memory when writing is slower than the model
+        self.error = None
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def write(self, feats, labels, ids):
+        #feats, labels: tensors on any device, the copy to host is started here and waited for by the writer thread. ids: numpy array
+        if self.error is not None:
+            raise self.error
+        done = None
+        device = feats.device
+        feats = feats.detach().to('cpu', non_blocking = True)
+        labels = labels.to('cpu', non_blocking = True)
+        if device.type == 'cuda': #the copy was queued on the stream of the features' device, not necessarily the current device
+            done = torch.cuda.Event()
+            done.record(torch.cuda.current_stream(device))
+        self.pending.put((feats, labels, ids, done))
+
+    def run(self):
+        while True:
+            batch = self.pending.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            feats, labels, ids, done = batch
+            try:
+                if done is not None:
+                    done.synchronize()
+                self.append(feats.numpy(), labels.numpy(), ids)
+            except Exception as e:
+                self.error = e
+
+    def append(self, feats, labels, ids):
+        n = feats.shape[0]
+        if self.all_feats is None:
+            chunk_rows = max(1, self.chunk_bytes // (np.dtype(self.dtype).itemsize * int(np.prod(feats.shape[1:]))))
+            self.all_feats = self.f.create_dataset('all_feats', (0,) + feats.shape[1:], maxshape = (None,) + feats.shape[1:],
+                                                   chunks = (chunk_rows,) + feats.shape[1:], dtype = self.dtype, compression = self.compression)
+        self.all_feats.resize(self.count + n, axis = 0)
+        self.all_labels.resize(self.count + n, axis = 0)
+        self.all_ids.resize(self.count + n, axis = 0)
+        self.all_feats[self.count: self.count + n] = feats
+        self.all_labels[self.count: self.count + n] = labels
+        self.all_ids[self.count: self.count + n] = ids
+        self.count += n
+
+    def close(self, complete = True):
+        #complete: every batch was written. count is only written then, an interrupted extraction deletes the file
+        #instead of leaving a truncated one that data.feature_loader would read as complete
+        self.pending.put(None)
+        self.thread.join()
+        complete = complete and self.error is None
+        if complete:
+            count_var = self.f.create_dataset('count', (1,), dtype='i')
+            count_var[0] = self.count
+        self.f.close()
+        if not complete:
+            os.remove(self.outfile)
+        if self.error is not None:
+            raise self.error
+
+def save_features(model, data_loader, outfile, ids, device = 'cuda', float16 = False, compression = 'lzf'):
+    #ids: filelist index of every image, in the order data_loader loads them
+    writer = FeatureWriter(outfile, float16 = float16, compression = compression)
+    count = 0
+    try:
+        with torch.no_grad():
+            for i, (x,y) in enumerate(data_loader):
+                if i%10 == 0:
+                    print('{:d}/{:d}'.format(i, len(data_loader)))
+                x = x.to(device)
+                feats = model(x)
+                writer.write(feats, y, ids[count: count + len(y)])
+                count += len(y)
+    except BaseException: #also KeyboardInterrupt
+        writer.close(complete = False)
+        raise
+    writer.close()
 
 if __name__ == '__main__':
     mp.set_start_method('spawn')
     params = parse_args('save_features')
 
 
-    assert params.method not in ['maml', 'maml_approx',  'tra_maml'], 'maml variants do not support save_feature and run'
-
     if 'Conv' in params.model:
       image_size = 84 
     else:
@@ -94,6 +166,8 @@ if __name__ == '__main__':
 
     if params.train_aug :
         checkpoint_dir += f'_{params.train_aug}'
+    if params.tra != 'none':
+        checkpoint_dir += f'_{params.tra}'
 
         
     if not params.method in ['baseline', 'baseline++'] :
@@ -110,8 +184,11 @@ if __name__ == '__main__':
     else:
         outfile = os.path.join( checkpoint_dir.replace("checkpoints","features"), split + ".hdf5") 
 
-    datamgr = SimpleDataManager(image_size, batch_size = 64)
-    data_loader = datamgr.get_data_loader(loadfile, aug = 'none')
+    datamgr = SimpleDataManager(image_size, batch_size = 64, device = params.device, cache_mb = params.image_cache_mb, packed = params.packed, num_workers = params.num_workers)
+    with open(loadfile, 'r') as f:
+        n_images = len(json.load(f)['image_labels'])
+    order = np.random.default_rng(0).permutation(n_images) #mixed classes in every batch, the BatchNorm2d_fw of maml variants normalizes with batch statistics
+    data_loader = datamgr.get_data_loader(loadfile, aug = 'none', order = order.tolist())
 
     if params.method in ['relationnet', 'relationnet_softmax']:
         if params.model == 'Conv4': 
@@ -120,13 +197,17 @@ if __name__ == '__main__':
             model = backbone.Conv6NP()
         else:
             model = model_dict[params.model]( flatten = False )
-    elif params.method in ['maml' , 'maml_approx', 'tra_maml']: 
-       raise ValueError('MAML variants do not support save feature')
+    elif params.method in ['maml' , 'maml_approx', 'tra_maml']: #meta-learned trunk, for test.py --feature_test
+       backbone.ConvBlock.maml = True
+       backbone.SimpleBlock.maml = True
+       backbone.BottleneckBlock.maml = True
+       backbone.ResNet.maml = True
+       model = model_dict[params.model]()
     else:
         model = model_dict[params.model]()
 
-    model = model.cuda()
-    tmp = torch.load(modelfile)
+    model = model.to(params.device)
+    tmp = torch.load(modelfile, map_location = params.device)
     state = tmp['state']
     state_keys = list(state.keys())
     for i, key in enumerate(state_keys):
@@ -142,4 +223,4 @@ if __name__ == '__main__':
     dirname = os.path.dirname(outfile)
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
-    save_features(model, data_loader, outfile)
+    save_features(model, data_loader, outfile, order, params.device, float16 = params.float16, compression = params.compression)
@@ -0,0 +1,145 @@
+# Grid of TRA configurations, several runs at a time: train.py then test.py (save_features.py in between for the
+# methods tested on saved features) for every (dataset, n_shot, min_step, max_step, width) combination.
+#  - every concurrent job owns a slot: a device (--devices, round robin) and its own CPU cores (--cores_per_job), the
+#    processes of a run are pinned to the cores of its slot and run as many torch threads and loader workers
+#  - images are decoded once per dataset by pack_images.py before the first run, every run then reads the shared
+#    memory-mapped packed arrays (--packed) instead of decoding its own copy
+#  - the output of each run goes to record/sweep_logs/<run>.log, the accuracy of all runs to one table,
+#    record/sweep_<time>.txt, rewritten as runs finish. test.py still appends every run to record/results.txt
+# Run:  python ./sweep.py --datasets Smear --n_shots 1 5 --max_steps 3 5 --widths 0.2 0.4 --jobs 4 --train_args="--stop_epoch 200"
+
+import argparse
+import itertools
+import os
+import queue
+import re
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import torch
+
+import configs
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def grid(params):
+    configs_ = []
+    if params.method != 'tra_maml': #no TRA schedule to sweep, one run per (dataset, n_shot)
+        return [ dict(dataset = dataset, n_shot = n_shot, tra = 'none') for dataset, n_shot in itertools.product(params.datasets, params.n_shots) ]
+    for dataset, n_shot, min_step, max_step, width in itertools.product(params.datasets, params.n_shots, params.min_steps, params.max_steps, params.widths):
+        if min_step > max_step:
+            continue
+        configs_.append(dict(dataset = dataset, n_shot = n_shot, tra = f'{min_step}-{max_step}-{width}'))
+    return configs_
+
+
+def slots(params):
+    #(device, cores) of every concurrent job, the cores of this process are split evenly between the jobs
+    cores = sorted(os.sched_getaffinity(0))
+    per_job = params.cores_per_job if params.cores_per_job > 0 else max(1, len(cores) // params.jobs)
+    return [ (params.devices[i % len(params.devices)], cores[(i* per_job) % len(cores):][:per_job] or cores[:per_job]) for i in range(params.jobs) ]
+
+
+def run_name(config):
+    return '%s_%dshot_%s' %(config['dataset'], config['n_shot'], config['tra'])
+
+
+def run_config(config, slots_free, params):
+    device, cores = slots_free.get()
+    try:
+        common = ['--dataset', config['dataset'], '--model', params.model, '--method', params.method,
+                  '--n_shot', str(config['n_shot']), '--device', device, '--num_workers', str(max(0, len(cores) - 1))]
+        if params.method == 'tra_maml': #--tra also names the checkpoint directory, other methods keep their usual one
+            common += ['--tra', config['tra']]
+        if not params.no_pack:
+            common.append('--packed')
+        common += shlex.split(params.args)
+        commands = [ ['train.py'] + common + shlex.split(params.train_args) ]
+        if params.method not in ['maml', 'maml_approx', 'tra_maml']:
+            commands.append(['save_features.py'] + common + shlex.split(params.save_features_args))
+        commands.append(['test.py'] + common + shlex.split(params.test_args))
+
+        env = dict(os.environ, OMP_NUM_THREADS = str(len(cores)), MKL_NUM_THREADS = str(len(cores)), PYTHONUNBUFFERED = '1') #unbuffered, so the log is live
+        log_file = os.path.join(params.record_dir, 'sweep_logs', run_name(config) + '.log')
+        result = dict(config, device = device, cores = len(cores), status = 'ok', train_hours = None, acc = None, ci = None)
+        start_time = time.time()
+        with open(log_file, 'w') as log:
+            for command in commands:
+                log.write('$ ' + ' '.join(command) + '\n')
+                log.flush()
+                start = os.path.getsize(log_file)
+                #pinned by taskset before exec, a preexec_fn is not safe to fork from the threads of this pool. The output goes
+                #straight to the log, so it can be followed while the run goes on and is kept if the sweep is killed
+                proc = subprocess.run(['taskset', '-c', ','.join(map(str, cores)), sys.executable] + command, stdout = log, stderr = subprocess.STDOUT,
+                                      env = env, cwd = ROOT)
+                with open(log_file, 'rb') as f:
+                    f.seek(start)
+                    output = f.read().decode(errors = 'replace')
+                if proc.returncode != 0:
+                    result['status'] = '%s failed (%d)' %(command[0], proc.returncode)
+                    break
+                times = re.findall(r'Total Training Time: ([\d.]+) h', output)
+                if times:
+                    result['train_hours'] = float(times[-1])
+                accs = re.findall(r'Test Acc = ([\d.]+)% ± ([\d.]+)%', output)
+                if command[0] == 'test.py' and accs:
+                    result['acc'], result['ci'] = map(float, accs[-1])
+        result['wall_hours'] = (time.time() - start_time) / 3600
+        return result
+    finally:
+        slots_free.put((device, cores))
+
+
+def write_table(results, out_file):
+    with open(out_file, 'w') as f:
+        f.write('%-14s %6s %-12s %-8s %5s %9s %9s %-18s %s\n' %('dataset', 'n_shot', 'tra', 'device', 'cores', 'train_h', 'wall_h', 'acc', 'status'))
+        for r in results:
+            acc = '%4.2f%% ± %4.2f%%' %(r['acc'], r['ci']) if r['acc'] is not None else '-'
+            train_h = '%.2f' %(r['train_hours']) if r['train_hours'] is not None else '-'
+            f.write('%-14s %6d %-12s %-8s %5d %9s %9.2f %-18s %s\n' %(r['dataset'], r['n_shot'], r['tra'], r['device'], r['cores'], train_h, r['wall_hours'], acc, r['status']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'grid of TRA configurations, several runs at a time')
+    parser.add_argument('--datasets'    , default=['Smear'], nargs='+', help='BreaKHis_40x, ISIC, Smear, cross_IDC')
+    parser.add_argument('--n_shots'     , default=[1], nargs='+', type=int)
+    parser.add_argument('--min_steps'   , default=[1], nargs='+', type=int)
+    parser.add_argument('--max_steps'   , default=[5], nargs='+', type=int)
+    parser.add_argument('--widths'      , default=[0.4], nargs='+', type=float)
+    parser.add_argument('--model'       , default='Conv4', help='model: Conv{4|6} / ResNet{10|18|34|50|101}')
+    parser.add_argument('--method'      , default='tra_maml')
+    parser.add_argument('--jobs'        , default=1, type=int, help='runs at the same time')
+    parser.add_argument('--devices'     , default=['cuda'] if torch.cuda.is_available() else ['cpu'], nargs='+', help='devices of the jobs, round robin, e.g. cuda:0 cuda:1')
+    parser.add_argument('--cores_per_job', default=0, type=int, help='CPU cores pinned to every job, 0 to split the cores of this process evenly')
+    parser.add_argument('--args'        , default='', help='extra arguments of every script, e.g. --args="--train_aug standard --train_n_way 3"')
+    parser.add_argument('--train_args'  , default='', help='extra train.py arguments for every run, e.g. --train_args="--stop_epoch 200"')
+    parser.add_argument('--save_features_args', default='', help='extra save_features.py arguments for every run')
+    parser.add_argument('--test_args'   , default='', help='extra test.py arguments for every run')
+    parser.add_argument('--no_pack'     , action='store_true', help='decode the JPEGs in every run instead of packing the datasets first')
+    params = parser.parse_args()
+
+    params.record_dir = configs.save_dir + '/record'
+    os.makedirs(os.path.join(params.record_dir, 'sweep_logs'), exist_ok = True)
+    out_file = os.path.join(params.record_dir, 'sweep_%s.txt' %(time.strftime("%Y%m%d-%H%M%S", time.localtime())))
+
+    if not params.no_pack: #decode every dataset once, all runs share the memory-mapped arrays
+        for dataset in params.datasets:
+            subprocess.run([sys.executable, 'pack_images.py', '--dataset', dataset, '--model', params.model, '--split', 'all', '--if_missing'], check = True, cwd = ROOT)
+
+    configs_ = grid(params)
+    slots_free = queue.Queue()
+    for slot in slots(params):
+        slots_free.put(slot)
+    print(f'{len(configs_)} runs, {params.jobs} at a time, results in {out_file}')
+
+    results = {}
+    with ThreadPoolExecutor(params.jobs) as pool: #each thread waits on the subprocesses of one run
+        futures = { pool.submit(run_config, config, slots_free, params): i for i, config in enumerate(configs_) }
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            write_table([ results[i] for i in sorted(results) ], out_file) #grid order
+            print('%s: %s' %(run_name(result), '%4.2f%% ± %4.2f%%' %(result['acc'], result['ci']) if result['acc'] is not None else result['status']))
@@ -17,6 +17,7 @@ import configs
 import backbone
 import data.feature_loader as feat_loader
 from data.datamgr import SetDataManager
+from data.manifest import get_manifest
 from methods.baselinetrain import BaselineTrain
 from methods.baselinefinetune import BaselineFinetune
 from methods.protonet import ProtoNet
@@ -24,21 +25,15 @@ from methods.matchingnet import MatchingNet
 from methods.relationnet import RelationNet
 from methods.maml import MAML
 from methods.tra_maml import TRA_MAML
+from parallel_eval import parallel_test
 
 
 from io_utils import model_dict, parse_args, get_resume_file, get_best_file , get_assigned_file, set_seed
 
 
-def feature_evaluation(cl_data_file, model, n_way = 5, n_support = 5, n_query = 15, adaptation = False):
-    class_list = cl_data_file.keys()
-    select_class = random.choices(list(class_list),k=n_way)
-    z_all  = []
-    for cl in select_class:
-        img_feat = cl_data_file[cl]
-        perm_ids = np.random.permutation(len(img_feat)).tolist()
-        z_all.append( [ np.squeeze( img_feat[perm_ids[i]]) for i in range(n_support+n_query) ] )     # stack each batch
-
-    z_all = torch.from_numpy(np.array(z_all) )
+def feature_evaluation(feats, ids, model, n_way = 5, n_support = 5, n_query = 15, adaptation = False):
+    #accuracy of one episode, ids: [n_way, n_support + n_query] feature rows
+    z_all = torch.from_numpy(feats[ids])
    
     model.n_query = n_query
     if adaptation:
@@ -50,6 +45,19 @@ def feature_evaluation(cl_data_file, model, n_way = 5, n_support = 5, n_query =
     acc = np.mean(pred == y)*100 
     return acc
 
+def feature_evaluation_batch(feats, ids, model, n_way = 5, n_support = 5, n_query = 15, episode_batch = 100):
+    #accuracies of all episodes, episode_batch of them per set_forward_batch call (ProtoNet, MatchingNet, MAML heads, BaselineFinetune solvers), ids: [iter_num, n_way, n_support + n_query]
+    model.n_query = n_query
+    y = np.repeat(range( n_way ), n_query )
+    acc_all = []
+    with torch.no_grad():
+        for i in tqdm(range(0, len(ids), episode_batch)):
+            z_all = torch.from_numpy(feats[ids[i: i+episode_batch]])
+            scores = model.set_forward_batch(z_all, is_feature = True)
+            pred = scores.cpu().numpy().argmax(axis = 2)
+            acc_all.append( np.mean(pred == y, axis = 1)*100 )
+    return np.concatenate(acc_all)
+
 if __name__ == '__main__':
     mp.set_start_method('spawn')
     
@@ -63,16 +71,15 @@ if __name__ == '__main__':
 
     params = parse_args('test')
 
-    acc_all = []
-    iter_num = 600
+    iter_num = params.iter_num
 
     few_shot_params = dict(n_way = params.test_n_way , n_support = params.n_shot) 
 
 
     if params.method == 'baseline':
-        model = BaselineFinetune( model_dict[params.model], **few_shot_params )
+        model = BaselineFinetune( model_dict[params.model], solver = params.finetune, ridge_lambda = params.ridge_lambda, **few_shot_params )
     elif params.method == 'baseline++':
-        model = BaselineFinetune( model_dict[params.model], loss_type = 'dist', **few_shot_params )
+        model = BaselineFinetune( model_dict[params.model], loss_type = 'dist', solver = params.finetune, ridge_lambda = params.ridge_lambda, **few_shot_params )
     elif params.method == 'protonet':
         model = ProtoNet( model_dict[params.model], **few_shot_params )
     elif params.method == 'matchingnet':
@@ -114,7 +121,7 @@ if __name__ == '__main__':
     else:
        raise ValueError('Unknown method')
 
-    model = model.cuda()
+    model = model.to(params.device)
 
     if params.dataset == 'cross_IDC':
         checkpoint_dir = '%s/checkpoints/%s/%s_%s' %(configs.save_dir, 'BreaKHis_40x', params.model, params.method)
@@ -137,7 +144,7 @@ if __name__ == '__main__':
         else:
             modelfile   = get_best_file(checkpoint_dir)
         if modelfile is not None:
-            tmp = torch.load(modelfile, weights_only=True)
+            tmp = torch.load(modelfile, map_location = params.device, weights_only=True)
             model.load_state_dict(tmp['state'])
             
 
@@ -146,7 +153,44 @@ if __name__ == '__main__':
         split_str = split + "_" +str(params.save_iter)
     else:
         split_str = split
-    if params.method in ['maml', 'maml_approx', 'tra_maml']: #maml do not support testing with feature
+    if params.dataset == 'BreaKHis_40x':
+      if split == 'base':
+          loadfile = configs.data_dir['BreaKHis_40x'] + 'base.json' 
+      else:
+          loadfile  = configs.data_dir['BreaKHis_40x'] + split + '.json'
+
+    elif params.dataset == 'ISIC':
+      if split == 'base':
+          loadfile = configs.data_dir['ISIC'] + 'base.json' 
+      else:
+          loadfile  = configs.data_dir['ISIC'] + split + '.json'
+
+    elif params.dataset == 'Smear':
+      if split == 'base':
+          loadfile = configs.data_dir['Smear'] + 'base.json' 
+      else:
+          loadfile  = configs.data_dir['Smear'] + split + '.json'
+
+  
+    elif params.dataset == 'cross_IDC':
+      if split == 'base':
+          loadfile = configs.data_dir['BreaKHis_40x'] + 'base.json' 
+      elif split == 'val':
+          loadfile  = configs.data_dir['BreaKHis_40x'] + 'val.json'
+      else:
+          loadfile  = configs.data_dir['BCHI'] + 'novel.json'
+
+
+    else:
+        raise ValueError(f"Unsupported dataset: {params.dataset}")
+
+    #the same episodes for every method and checkpoint tested on this split
+    with open(loadfile, 'r') as f:
+        labels = json.load(f)['image_labels']
+    manifest_file = os.path.join(configs.save_dir, 'manifests', '%s_%s_%dway_%dshot_%d_seed%d.npz' %(params.dataset, split, params.test_n_way, params.n_shot, iter_num, params.episode_seed))
+    manifest = get_manifest(manifest_file, labels, params.test_n_way, params.n_shot + 15, iter_num, seed = params.episode_seed)
+
+    if params.method in ['maml', 'maml_approx', 'tra_maml'] and not params.feature_test: #full adaptation of backbone and head on images
         if 'Conv' in params.model:
             image_size = 84 
   
@@ -154,58 +198,43 @@ if __name__ == '__main__':
             image_size = 224
 
      
-        datamgr  = SetDataManager(image_size, n_eposide = iter_num, n_query = 15 , **few_shot_params)
-
-
-      
-        if params.dataset == 'BreaKHis_40x':
-          if split == 'base':
-              loadfile = configs.data_dir['BreaKHis_40x'] + 'base.json' 
-          else:
-              loadfile  = configs.data_dir['BreaKHis_40x'] + split + '.json'
-
-        elif params.dataset == 'ISIC':
-          if split == 'base':
-              loadfile = configs.data_dir['ISIC'] + 'base.json' 
-          else:
-              loadfile  = configs.data_dir['ISIC'] + split + '.json'
-
-        elif params.dataset == 'Smear':
-          if split == 'base':
-              loadfile = configs.data_dir['Smear'] + 'base.json' 
-          else:
-              loadfile  = configs.data_dir['Smear'] + split + '.json'
-
-      
-        elif params.dataset == 'cross_IDC':
-          if split == 'base':
-              loadfile = configs.data_dir['BreaKHis_40x'] + 'base.json' 
-          elif split == 'val':
-              loadfile  = configs.data_dir['BreaKHis_40x'] + 'val.json'
-          else:
-              loadfile  = configs.data_dir['BCHI'] + 'novel.json'
-
-
-        else:
-            raise ValueError(f"Unsupported dataset: {params.dataset}")
-           
-
-        novel_loader     = datamgr.get_data_loader( loadfile, aug = 'none')
+        datamgr  = SetDataManager(image_size, n_eposide = iter_num, n_query = 15 , device = params.device, cache_mb = params.image_cache_mb, packed = params.packed,
+                                   num_workers = params.num_workers, prefetch_factor = params.prefetch_factor, persistent_workers = params.persistent_workers, **few_shot_params)
+        episode_ids = manifest.image_ids(labels)
 
         if params.adaptation:
             model.task_update_num = 100 #We perform adaptation on MAML simply by updating more times.
+            model.test_steps = 100 #tra_maml sets task_update_num again in every forward
         model.eval()
-        acc_mean, acc_std, avg_loss = model.test_loop( novel_loader, return_std = True)
+        if params.test_workers > 0:
+            novel_dataset = datamgr.get_dataset( loadfile, aug = 'none')
+            acc_mean, acc_std, avg_loss = parallel_test(model, novel_dataset, episode_ids, workers = params.test_workers, threads = params.threads_per_worker)
+        else:
+            novel_loader     = datamgr.get_episode_loader( loadfile, aug = 'none', episode_ids = episode_ids)
+            acc_mean, acc_std, avg_loss = model.test_loop( novel_loader, return_std = True)
 
     else:
         novel_file = os.path.join( checkpoint_dir.replace("checkpoints","features"), split_str +".hdf5") #defaut split = novel, but you can also test base or val classes
-        cl_data_file = feat_loader.init_loader(novel_file)
-
-        for i in tqdm(range(iter_num)):     
-            acc = feature_evaluation(cl_data_file, model, n_query = 15, adaptation = params.adaptation, **few_shot_params)
-            acc_all.append(acc)
+        cl_data_file = feat_loader.init_loader(novel_file, mmap = params.mmap_features)
+        feats = cl_data_file.feats
+        episode_ids = manifest.feature_ids(cl_data_file)
+        maml_head = params.method in ['maml', 'maml_approx', 'tra_maml'] #--feature_test: adapt only the classifier on the features of the frozen trunk
+        if maml_head:
+            if params.adaptation:
+                model.task_update_num = 100
+                model.test_steps = 100
+            model.eval()
+
+        if params.method in ['baseline', 'baseline++']:
+            batched = params.finetune != 'sgd' #heads of episode_batch episodes trained together
+        else:
+            batched = hasattr(model, 'set_forward_batch') and (maml_head or not params.adaptation)
+        if batched:
+            acc_all = feature_evaluation_batch(feats, episode_ids, model, n_query = 15, episode_batch = params.episode_batch, **few_shot_params)
+        else:
+            acc_all = [ feature_evaluation(feats, ids, model, n_query = 15, adaptation = params.adaptation, **few_shot_params) for ids in tqdm(episode_ids) ]
+            acc_all = np.asarray(acc_all)
 
-        acc_all  = np.asarray(acc_all)
         acc_mean = np.mean(acc_all)
         acc_std  = np.std(acc_all)
         print('%d Test Acc = %4.2f%% ± %4.2f%%' %(iter_num, acc_mean, 1.96* acc_std/np.sqrt(iter_num)))
@@ -217,6 +246,8 @@ if __name__ == '__main__':
         if hasattr(model, 'experimental'):
             aug_str += f'-{model.experimental}'
         aug_str += '-adapted' if params.adaptation else ''
+        aug_str += '-features' if params.feature_test else ''
+        aug_str += f'-{params.finetune}' if params.method in ['baseline', 'baseline++'] and params.finetune != 'sgd' else ''
         if params.method in ['baseline', 'baseline++'] :
             exp_setting = '%s-%s-%s-%s%s %sshot %sway_test' %(params.dataset, split_str, params.model, params.method, aug_str, params.n_shot, params.test_n_way )
         else:
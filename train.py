@@ -8,11 +8,12 @@ import os
 import glob
 import math
 import collections
+import json
 
 
 import configs
 import backbone
-from data.datamgr import SimpleDataManager, SetDataManager
+from data.datamgr import SimpleDataManager, SetDataManager, FixedEpisodes
 from methods.baselinetrain import BaselineTrain
 from methods.baselinefinetune import BaselineFinetune
 from methods.protonet import ProtoNet
@@ -20,11 +21,35 @@ from methods.matchingnet import MatchingNet
 from methods.relationnet import RelationNet
 from methods.maml import MAML
 from methods.tra_maml import TRA_MAML
+from methods.trapezoidal_step_scheduler import BudgetedTRA
 import torch.multiprocessing as mp
 from io_utils import model_dict, parse_args, get_resume_file, set_seed
+from profiling import Profiler, reset_peak_memory, peak_memory
+from checkpointing import CheckpointManager, set_rng_state
 
 
-def train(base_loader, val_loader, model, optimization, start_epoch, stop_epoch, params, patience_ratio=0.1, warmup_epochs_ratio = 0.25):    
+def cache_budgets(cache_mb, data_files):
+    #--image_cache_mb split between the loaders of data_files in proportion to their image counts, so together they keep at most cache_mb
+    if cache_mb <= 0:
+        return [0]* len(data_files)
+    sizes = []
+    for data_file in data_files:
+        with open(data_file, 'r') as f:
+            sizes.append(len(json.load(f)['image_names']))
+    return [ cache_mb* n/ sum(sizes) for n in sizes ]
+
+
+def training_state(model, loaders, **counters):
+    #what --resume needs besides the weights, optimizer and RNG states to continue the run exactly: the counters of
+    #train(), the TRA schedule state of the model and the class cursors of the episode samplers
+    state = { name: value.item() if isinstance(value, np.generic) else value for name, value in counters.items() } #numpy scalars do not load with weights_only
+    if hasattr(model, 'train_state'):
+        state['model'] = model.train_state()
+    state['samplers'] = [ loader.sampler.state_dict() if hasattr(loader.sampler, 'state_dict') else None for loader in loaders ]
+    return state
+
+
+def train(base_loader, val_loader, model, optimization, start_epoch, stop_epoch, params, patience_ratio=0.1, warmup_epochs_ratio = 0.25, resume_state = None):    
     learning_rate = 0.0001
     if optimization == 'Adam':
           print(f'With scalar Learning rate, Adam LR:{learning_rate}')
@@ -32,23 +57,70 @@ def train(base_loader, val_loader, model, optimization, start_epoch, stop_epoch,
          
     else:
        raise ValueError('Unknown optimization, please define by yourself')
+
+    val_episodes = val_loader
+    if params.val_episodes > 0 and params.method not in ['baseline', 'baseline++']: #drawn before a resumed run restores its RNG state, so it gets the same episodes
+        val_episodes = FixedEpisodes(val_loader, params.val_episodes)
+
+    if resume_state is not None: #checkpoints written before the optimizer and RNG states were saved only restore the model
+        if 'optimizer' in resume_state:
+            optimizer.load_state_dict(resume_state['optimizer'])
+        if 'rng' in resume_state:
+            set_rng_state(resume_state['rng'])
+    checkpoints = CheckpointManager(params.checkpoint_dir, keep_last = params.keep_checkpoints)
   
     max_acc = 0   
     total_training_time = 0
     scheduler = None
-   
-    # Initialize early stopping variables
-    patience = int(patience_ratio * (stop_epoch - start_epoch))
-    warmup_epochs = int(warmup_epochs_ratio * (stop_epoch - start_epoch))
+    first_epoch = start_epoch
     early_stopping_counter = 0
+
+    if resume_state is not None and 'train_state' in resume_state:
+        state = resume_state['train_state']
+        max_acc = state['max_acc']
+        early_stopping_counter = state['early_stopping_counter']
+        total_training_time = state['total_training_time']
+        first_epoch = state['first_epoch']
+        if 'model' in state:
+            model.load_train_state(state['model'])
+        for loader, sampler_state in zip([base_loader, val_loader], state['samplers']):
+            if sampler_state is not None and hasattr(loader.sampler, 'load_state_dict'):
+                loader.sampler.load_state_dict(sampler_state)
+        best_file = os.path.join(params.checkpoint_dir, 'best_model.tar')
+        if os.path.isfile(best_file): #a best model saved after the resumed checkpoint is only replaced by a better one
+            best_state = torch.load(best_file, map_location = 'cpu').get('train_state')
+            if best_state is not None:
+                max_acc = max(max_acc, best_state['max_acc'])
+   
+    # Initialize early stopping variables, over the whole run when resumed
+    patience = int(patience_ratio * (stop_epoch - first_epoch))
+    warmup_epochs = int(warmup_epochs_ratio * (stop_epoch - first_epoch))
     
+    if params.profile != 'none':
+        model.profiler = Profiler(params.device, count_allocations = params.profile_allocations)
+
     timestamp_start = time.strftime("%Y%m%d-%H%M%S", time.localtime()) 
     with open(os.path.join(params.checkpoint_dir, 'training_logs.txt'), 'a') as log_file:
         log_file.write(f'Time: {timestamp_start}, Training Start\n')
+        if hasattr(model, 'schedule'): #TRA inner steps of every epoch, steps x epochs; also saved as an array for plotting
+            log_file.write(f'TRA Schedule: {model.schedule.describe()}\n')
+            np.save(os.path.join(params.checkpoint_dir, 'tra_schedule.npy'), model.schedule.table)
 
 
     for epoch in range(start_epoch,stop_epoch):
         start_time = time.time() # record start time
+        reset_peak_memory(params.device)
+        if model.profiler is not None:
+            model.profiler.start_epoch(epoch)
+        budget = getattr(model, 'budget', None)
+        if budget is not None:
+            if budget.exhausted(epoch, total_training_time):
+                print(f"TRA budget exhausted at epoch {epoch}")
+                break
+            plateau = budget.plan(epoch, total_training_time)
+            with open(os.path.join(params.checkpoint_dir, 'training_logs.txt'), 'a') as log_file:
+                predicted = f'{budget.predicted_s:.0f}s' if budget.predicted_s is not None else 'not measured yet'
+                log_file.write(f'Epoch: {epoch}, TRA Budget: plateau {plateau} steps, spent {total_training_time:.0f}s of {budget.budget_s:.0f}s, predicted remaining {predicted}\n')
         model.train()
         model.train_loop(epoch, base_loader,  optimizer) #model are called by reference, no need to return 
 
@@ -58,19 +130,53 @@ def train(base_loader, val_loader, model, optimization, start_epoch, stop_epoch,
         if not os.path.isdir(params.checkpoint_dir):
             os.makedirs(params.checkpoint_dir)
 
-        acc, avg_loss = model.test_loop(val_loader)
+        acc = None #no validation in this epoch
+        if epoch % params.val_freq == 0 or epoch == stop_epoch - 1:
+          if params.method in ['baseline', 'baseline++']:
+            acc, avg_loss = model.test_loop(val_episodes)
+            acc_ci = None
+          else:
+            acc, acc_std, avg_loss = model.test_loop(val_episodes, return_std = True)
+            acc_ci = 1.96* acc_std / np.sqrt(len(val_episodes)) #half width of the 95% interval of the mean accuracy
    
         # Save validation accuracy and training time to a text file
         with open(os.path.join(params.checkpoint_dir, 'training_logs.txt'), 'a') as log_file:
-          log_file.write(f'Epoch: {epoch}, Validation Accuracy: {acc:.4f}, Validation Loss: {avg_loss:.4f}\n')
-
+          if acc is not None:
+            ci = f', Validation CI: ±{acc_ci:.4f} ({len(val_episodes)} episodes)' if acc_ci is not None else ''
+            log_file.write(f'Epoch: {epoch}, Validation Accuracy: {acc:.4f}, Validation Loss: {avg_loss:.4f}{ci}\n')
+          order = f", Inner Loop: {'first' if model.first_order() else 'second'} order" if hasattr(model, 'first_order') else ''
+          if torch.device(params.device).type == 'cuda':
+            memory = f'Peak Memory: {peak_memory(params.device)/2**20:.0f} MB' #training and validation of this epoch
+          else:
+            memory = f'Process Peak RSS: {peak_memory(params.device)/2**20:.0f} MB' #since the process started, not comparable across epochs
+          log_file.write(f'Epoch: {epoch}, Epoch Time: {time.time() - start_time:.1f}s, {memory}{order}\n')
+          for split, loader in [('Train', base_loader), ('Validation', val_loader)]:
+            if getattr(loader.dataset, 'cache', None) is not None:
+              stats = loader.dataset.cache.stats()
+              log_file.write(f"Epoch: {epoch}, {split} Image Cache: hits {stats['hits']}, misses {stats['misses']}, hit rate {stats['hit_rate']:.4f}, evictions {stats['evictions']}, used {stats['used_bytes']/2**20:.1f}/{stats['capacity_bytes']/2**20:.1f} MB\n")
+
+        if model.profiler is not None:
+          summary = model.profiler.end_epoch()
+          if hasattr(model, 'task_update_num'):
+            summary['task_update_num'] = model.task_update_num #the TRA inner step count of this epoch
+          if params.profile == 'jsonl':
+            with open(os.path.join(params.checkpoint_dir, 'profile.jsonl'), 'a') as profile_file:
+              profile_file.write(json.dumps(summary) + '\n')
+          else:
+            with open(os.path.join(params.checkpoint_dir, 'training_logs.txt'), 'a') as log_file:
+              log_file.write(Profiler.format(summary) + '\n')
+
+
+        if acc is None:
+          pass
 
-        if acc > max_acc : #for baseline and baseline++, we don't use validation in default and we let acc = -1, but we allow options to validate with DB index
+        elif acc > max_acc : #for baseline and baseline++, we don't use validation in default and we let acc = -1, but we allow options to validate with DB index
             print("best model! save...")
             max_acc = acc
             early_stopping_counter = 0
-            outfile = os.path.join(params.checkpoint_dir, 'best_model.tar')
-            torch.save({'epoch':epoch, 'state':model.state_dict()}, outfile)
+            checkpoints.save(epoch, model, optimizer, best = True,
+                             train_state = training_state(model, [base_loader, val_loader], max_acc = max_acc, early_stopping_counter = early_stopping_counter,
+                                                          total_training_time = total_training_time + time.time() - start_time, first_epoch = first_epoch))
 
         elif acc == -1: #for baseline and baseline++
           pass
@@ -78,7 +184,7 @@ def train(base_loader, val_loader, model, optimization, start_epoch, stop_epoch,
         else:
           # Skip early stopping check during warm-up period
           if epoch >= warmup_epochs:
-               early_stopping_counter += 1
+               early_stopping_counter += params.val_freq #patience is counted in epochs
 
         # If validation accuracy hasn't improved for patience epochs, increase patience
         if early_stopping_counter >= patience and epoch >= warmup_epochs:
@@ -89,14 +195,18 @@ def train(base_loader, val_loader, model, optimization, start_epoch, stop_epoch,
 
 
         if (epoch % params.save_freq==0) or (epoch==stop_epoch-1):
-            outfile = os.path.join(params.checkpoint_dir, '{:d}.tar'.format(epoch))
-            torch.save({'epoch':epoch, 'state':model.state_dict()}, outfile)
+            checkpoints.save(epoch, model, optimizer, periodic = True,
+                             train_state = training_state(model, [base_loader, val_loader], max_acc = max_acc, early_stopping_counter = early_stopping_counter,
+                                                          total_training_time = total_training_time + time.time() - start_time, first_epoch = first_epoch))
 
             
         elapsed_time = time.time() - start_time # calculate elapsed time
         total_training_time += elapsed_time
+        if budget is not None:
+            budget.record(model.task_update_num, elapsed_time)
       
         
+    checkpoints.close() # wait for the last checkpoints to be written
     elapsed_hours = total_training_time / 3600.0 # convert to hours
     print(f"Total Training Time: {elapsed_hours:.2f} h") # print elapsed time for current epoch in hours
 
@@ -155,10 +265,11 @@ if __name__=='__main__':
     print('Dataset:', params.dataset, 'N-SHOT: ', params.n_shot)
     print(f'Applying {params.train_aug} Data Augmentation ......')
     
+    base_cache_mb, val_cache_mb = cache_budgets(params.image_cache_mb, [base_file, val_file])
     if params.method in ['baseline', 'baseline++'] :
-      base_datamgr    = SimpleDataManager(image_size, batch_size = 16)
+      base_datamgr    = SimpleDataManager(image_size, batch_size = 16, device = params.device, cache_mb = base_cache_mb, packed = params.packed, num_workers = params.num_workers)
       base_loader     = base_datamgr.get_data_loader( base_file , aug = params.train_aug)
-      val_datamgr     = SimpleDataManager(image_size, batch_size = 64)
+      val_datamgr     = SimpleDataManager(image_size, batch_size = 64, device = params.device, cache_mb = val_cache_mb, packed = params.packed, num_workers = params.num_workers)
       val_loader      = val_datamgr.get_data_loader( val_file, aug = 'none')
      
       if params.method == 'baseline':
@@ -173,10 +284,12 @@ if __name__=='__main__':
         train_few_shot_params    = dict(n_way = params.train_n_way, n_support = params.n_shot) 
         test_few_shot_params     = dict(n_way = params.test_n_way, n_support = params.n_shot) 
 
-        base_datamgr = SetDataManager(image_size, n_query = n_query,  **train_few_shot_params)
+        base_datamgr = SetDataManager(image_size, n_query = n_query, device = params.device, cache_mb = base_cache_mb, packed = params.packed,
+                                     num_workers = params.num_workers, prefetch_factor = params.prefetch_factor, persistent_workers = params.persistent_workers, **train_few_shot_params)
         base_loader  = base_datamgr.get_data_loader( base_file , aug = params.train_aug)
         
-        val_datamgr = SetDataManager(image_size, n_query = n_query, **test_few_shot_params)
+        val_datamgr = SetDataManager(image_size, n_query = n_query, device = params.device, cache_mb = val_cache_mb, packed = params.packed,
+                                     num_workers = params.num_workers, prefetch_factor = params.prefetch_factor, persistent_workers = params.persistent_workers, **test_few_shot_params)
         val_loader = val_datamgr.get_data_loader( val_file, aug = 'none') 
         #a batch for SetDataManager: a [n_way, n_support + n_query, dim, w, h] tensor  
 
@@ -201,9 +314,10 @@ if __name__=='__main__':
           backbone.SimpleBlock.maml = True
           backbone.BottleneckBlock.maml = True
           backbone.ResNet.maml = True
+          second_order_steps = params.second_order_steps if params.second_order_steps >= 0 else None
 
           if params.method in ['maml', 'maml_approx']:
-            model = MAML(  model_dict[params.model], approx = (params.method == 'maml_approx') , **train_few_shot_params )
+            model = MAML(  model_dict[params.model], approx = (params.method == 'maml_approx') , batch_tasks = params.batch_tasks, second_order_steps = second_order_steps, first_order_epochs = params.first_order_epochs, **train_few_shot_params )
        
 
           elif params.method == 'tra_maml':
@@ -217,7 +331,13 @@ if __name__=='__main__':
                              width = float(tra[2]),
                              test_mode = False,
                              approx = False, 
+                             batch_tasks = params.batch_tasks,
+                             total_epochs = params.stop_epoch,
+                             second_order_steps = second_order_steps,
+                             first_order_epochs = params.first_order_epochs,
                              **train_few_shot_params )
+            if params.tra_budget_hours > 0:
+                model.budget = BudgetedTRA(params.tra_budget_hours * 3600, params.stop_epoch, model.min_step, model.max_step, model.width)
 
        
               
@@ -226,7 +346,7 @@ if __name__=='__main__':
 
 
     
-    model = model.cuda()
+    model = model.to(params.device)
 
     if params.dataset == 'cross_IDC':
       params.checkpoint_dir = '%s/checkpoints/%s/%s_%s' %(configs.save_dir, 'BreaKHis_40x', params.model, params.method)
@@ -248,12 +368,14 @@ if __name__=='__main__':
     stop_epoch = params.stop_epoch
    
 
+    resume_state = None
     if params.resume:
         resume_file = get_resume_file(params.checkpoint_dir)
         if resume_file is not None:
-            tmp = torch.load(resume_file)
+            tmp = torch.load(resume_file, map_location = 'cpu') #the RNG and sampler states must stay on host, the model and optimizer states are copied to the device on load
             start_epoch = tmp['epoch']+1
             model.load_state_dict(tmp['state'])
+            resume_state = tmp
 
 
-    model = train(base_loader, val_loader,  model, optimization, start_epoch, stop_epoch, params)
+    model = train(base_loader, val_loader,  model, optimization, start_epoch, stop_epoch, params, resume_state = resume_state)
@@ -2,7 +2,7 @@ import torch
 import numpy as np
 
 def one_hot(y, num_class):         
-    return torch.zeros((len(y), num_class)).scatter_(1, y.unsqueeze(1), 1)
+    return torch.zeros((len(y), num_class), device = y.device).scatter_(1, y.unsqueeze(1), 1)
 
 def DBindex(cl_data_file):
     class_list = cl_data_file.keys()